@@ -27,6 +27,11 @@
 #define COMMAND_GET_STATE 0x01
 #define COMMAND_SET_COLOR 0x02
 #define COMMAND_SET_BLINKING 0x03
+#define COMMAND_SET_GROUPS 0x04
+// Group commands are written to the general call address, which TinyWireS also receives, and
+// apply to every pedestal in any of the groups in the command's group bitmask
+#define COMMAND_GROUP_SET_COLOR 0x05
+#define COMMAND_GROUP_SET_BLINKING 0x06
 
 // The command that determines the context of data requested or sent by the controller
 uint8_t command = UNKNOWN_COMMAND;
@@ -51,6 +56,21 @@ uint8_t prevBlue = blue;
 uint8_t blinking = EEPROM.read(EEPROM_BLINKING_ADDR);
 uint8_t prevBlinking = blinking;
 
+// Bitmask of the groups the pedestal belongs to, sent by the hub whenever the pedestal is
+// attached so it isn't saved to EEPROM
+uint8_t groups = 0;
+
+// Milliseconds the state must stay unchanged before it's written to EEPROM, so rapid changes
+// such as the hub's effects don't wear out the EEPROM
+#define EEPROM_WRITE_DELAY 2000
+
+// The state as of the last loop, and when it last changed
+uint8_t lastRed = red;
+uint8_t lastGreen = green;
+uint8_t lastBlue = blue;
+uint8_t lastBlinking = blinking;
+long lastStateChange = 0;
+
 #define NUM_PIXELS 1
 #define LED_PIN 2
 #define LED_PERIOD 16
@@ -116,40 +136,65 @@ void loop()
     led.show();
   }
 
-  // Check for I2C stop bit
+  // Check for I2C stop bit, with interrupts disabled so requestEvent can't read the receive
+  // buffer at the same time. The USI holds the clock low until its interrupts are handled.
+  noInterrupts();
   TinyWireS_stop_check();
+  interrupts();
 
-  // If state changed, write to EEPROM
-  if (red != prevRed)
-  {
-    EEPROM.write(EEPROM_RED_ADDR, red);
-    prevRed = red;
-  }
-  if (blue != prevBlue)
+  if (red != lastRed || green != lastGreen || blue != lastBlue || blinking != lastBlinking)
   {
-    EEPROM.write(EEPROM_BLUE_ADDR, blue);
-    prevBlue = blue;
+    lastRed = red;
+    lastGreen = green;
+    lastBlue = blue;
+    lastBlinking = blinking;
+    lastStateChange = currentTime;
   }
-  if (green != prevGreen)
-  {
-    EEPROM.write(EEPROM_GREEN_ADDR, green);
-    prevGreen = green;
-  }
-  if (blinking != prevBlinking)
+
+  // If state changed and has settled, write to EEPROM
+  if (currentTime - lastStateChange > EEPROM_WRITE_DELAY)
   {
-    EEPROM.write(EEPROM_BLINKING_ADDR, blinking);
-    prevBlinking = blinking;
+    if (red != prevRed)
+    {
+      EEPROM.write(EEPROM_RED_ADDR, red);
+      prevRed = red;
+    }
+    if (blue != prevBlue)
+    {
+      EEPROM.write(EEPROM_BLUE_ADDR, blue);
+      prevBlue = blue;
+    }
+    if (green != prevGreen)
+    {
+      EEPROM.write(EEPROM_GREEN_ADDR, green);
+      prevGreen = green;
+    }
+    if (blinking != prevBlinking)
+    {
+      EEPROM.write(EEPROM_BLINKING_ADDR, blinking);
+      prevBlinking = blinking;
+    }
   }
 }
 
 // Called on peripheral read, peripheral should write bytes to the controller
 void requestEvent()
 {
+  // The receive callback normally runs from the main loop once the stop bit is seen, but the
+  // controller writes each command and reads the response with a repeated start, so there is
+  // no stop bit before the read. Apply any pending command first so SET_COLOR and SET_BLINKING
+  // respond with the state after the write, and the controller never needs a separate
+  // GET_STATE read.
+  uint8_t available = TinyWireS.available();
+  if (available > 0)
+    receiveEvent(available);
+
   switch (command)
   {
   case COMMAND_GET_STATE:
   case COMMAND_SET_COLOR:
   case COMMAND_SET_BLINKING:
+  case COMMAND_SET_GROUPS:
     writeState();
     break;
   }
@@ -185,25 +230,66 @@ void receiveEvent(uint8_t available)
     break;
   case COMMAND_SET_COLOR:
     if (TinyWireS.available() != 3)
+    {
       // Expect 3 bytes for the color values, if not drain the buffer
       drainRxBuffer();
+      break;
+    }
     red = TinyWireS.read();
     green = TinyWireS.read();
     blue = TinyWireS.read();
     break;
   case COMMAND_SET_BLINKING:
     if (TinyWireS.available() != 1)
+    {
       // Expect 1 byte for the blinking state, if not drain the buffer
       drainRxBuffer();
+      break;
+    }
     blinking = TinyWireS.read();
     break;
+  case COMMAND_SET_GROUPS:
+    if (TinyWireS.available() != 1)
+    {
+      // Expect 1 byte for the group bitmask, if not drain the buffer
+      drainRxBuffer();
+      break;
+    }
+    groups = TinyWireS.read();
+    break;
+  case COMMAND_GROUP_SET_COLOR:
+    if (TinyWireS.available() != 4)
+    {
+      // Expect 1 byte for the group bitmask and 3 bytes for the color values
+      drainRxBuffer();
+      break;
+    }
+    if (TinyWireS.read() & groups)
+    {
+      red = TinyWireS.read();
+      green = TinyWireS.read();
+      blue = TinyWireS.read();
+    }
+    drainRxBuffer();
+    break;
+  case COMMAND_GROUP_SET_BLINKING:
+    if (TinyWireS.available() != 2)
+    {
+      // Expect 1 byte for the group bitmask and 1 byte for the blinking state
+      drainRxBuffer();
+      break;
+    }
+    if (TinyWireS.read() & groups)
+      blinking = TinyWireS.read();
+    drainRxBuffer();
+    break;
   }
 }
 
 // Reads and drops any unexpected data in the receive buffer
 void drainRxBuffer()
 {
-  for (uint8_t i = 0; i < TinyWireS.available(); i++)
+  while (TinyWireS.available() > 0)
     TinyWireS.read();
 }
 
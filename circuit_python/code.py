@@ -4,13 +4,18 @@ import board
 import digitalio
 
 from peripheral import BLEClient
+from peripheral_transport import BLETransport
+
+# The BLE name the hub advertises, set to the hub's name in the backend's HUBS when the backend
+# connects to several hubs, or None to advertise the default name
+HUB_NAME = None
 
 led = digitalio.DigitalInOut(board.LED)
 led.direction = digitalio.Direction.OUTPUT
 
 
 async def main():
-    ble_client = BLEClient()
+    ble_client = BLEClient(transport=BLETransport(name=HUB_NAME))
     asyncio.create_task(ble_client.connect())
 
     while True:
@@ -0,0 +1,162 @@
+import asyncio
+import time
+import adafruit_logging as logging
+
+from log import MyHandler
+from command import Easing
+
+# Frames per second written to pedestals running an effect
+FRAME_RATE = 30
+
+
+def ease(easing, t):
+    """Maps progress between two keyframes, from 0 to 1, through the easing curve."""
+    if easing == Easing.EASE_IN:
+        return t * t
+    if easing == Easing.EASE_OUT:
+        return t * (2 - t)
+    if easing == Easing.EASE_IN_OUT:
+        if t < 0.5:
+            return 2 * t * t
+        return -1 + (4 - 2 * t) * t
+    return t
+
+
+class Effect:
+    def __init__(self, addresses, duration, easing, loop, keyframes, start):
+        """
+        Args:
+            addresses (List[int]): The pedestals running the effect
+            duration (float): Seconds for one pass through the keyframes
+            easing (Easing): The curve between each pair of keyframes
+            loop (bool): Whether the effect repeats until stopped
+            keyframes (List[Tuple[int, int, int, int]]): (position, red, green, blue) tuples,
+                sorted by position from 0 to 255 across the duration
+            start (float): The monotonic time the effect started
+        """
+        self.addresses = addresses
+        self.duration = duration
+        self.easing = easing
+        self.loop = loop
+        self.keyframes = keyframes
+        self.start = start
+
+    def color_at(self, now):
+        """Returns the (red, green, blue) color at the time, and whether the effect has finished."""
+        elapsed = now - self.start
+        if self.duration <= 0:
+            return self.keyframes[-1][1:], not self.loop
+        if self.loop:
+            elapsed = elapsed % self.duration
+        elif elapsed >= self.duration:
+            return self.keyframes[-1][1:], True
+        position = 255 * elapsed / self.duration
+
+        previous = self.keyframes[0]
+        if position <= previous[0]:
+            return previous[1:], False
+        for keyframe in self.keyframes[1:]:
+            if position <= keyframe[0]:
+                t = ease(self.easing, (position - previous[0]) / (keyframe[0] - previous[0]))
+                return (
+                    tuple(
+                        round(start + (end - start) * t)
+                        for start, end in zip(previous[1:], keyframe[1:])
+                    ),
+                    False,
+                )
+            previous = keyframe
+        return previous[1:], False
+
+
+class EffectEngine:
+    """
+    Runs effects on the hub, writing interpolated frames to the pedestals at a fixed rate.
+
+    Each pedestal runs at most one effect, starting an effect replaces any other effect on its
+    pedestals. Frames are only written to pedestals whose color changes. If writing a frame
+    takes longer than the frame interval the missed frames are dropped, so effects keep time
+    rather than falling behind.
+    """
+
+    def __init__(self, i2c_controller, frame_rate=FRAME_RATE):
+        """
+        Args:
+            i2c_controller (I2CController): Writes frames to the pedestals
+            frame_rate (int): Frames per second
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)  # type: ignore
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
+        self.i2c_controller = i2c_controller
+        self.frame_interval = 1 / frame_rate
+        self.effects = []
+        self.dropped_frames = 0
+        self.task = None
+
+    def start(self, addresses, duration, easing, loop, keyframes):
+        """
+        Starts an effect on the pedestals, stopping any effects already running on them. An
+        effect without keyframes only stops effects.
+
+        Args:
+            addresses (List[int]): The pedestals to run the effect on
+            duration (int): Milliseconds for one pass through the keyframes
+            easing (Easing): The curve between each pair of keyframes
+            loop (int): 1 to repeat the effect until stopped, otherwise 0
+            keyframes (List[Tuple[int, int, int, int]]): (position, red, green, blue) tuples,
+                with positions from 0 to 255 across the duration
+        """
+        self.stop(addresses)
+        if not addresses or not keyframes:
+            return
+        keyframes = sorted(keyframes, key=lambda keyframe: keyframe[0])
+        self.effects.append(
+            Effect(
+                list(addresses),
+                duration / 1000,
+                easing,
+                bool(loop),
+                keyframes,
+                time.monotonic(),
+            )
+        )
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._run())
+
+    def stop(self, addresses):
+        """Stops effects on the pedestals, leaving them at their current color."""
+        for effect in self.effects:
+            effect.addresses = [a for a in effect.addresses if a not in addresses]
+        self.effects = [effect for effect in self.effects if effect.addresses]
+
+    async def _run(self):
+        next_frame = time.monotonic()
+        while self.effects:
+            now = time.monotonic()
+            colors = []
+            for effect in self.effects:
+                color, finished = effect.color_at(now)
+                for address in effect.addresses:
+                    if address not in self.i2c_controller.pedestal_addresses:
+                        continue
+                    state = self.i2c_controller.pedestal_states.get(address, None)
+                    if state is None or tuple(state[:3]) != tuple(color):
+                        colors.append((address, color[0], color[1], color[2]))
+                if finished:
+                    effect.addresses = []
+            self.effects = [effect for effect in self.effects if effect.addresses]
+            if colors:
+                await self.i2c_controller.set_pedestals_color(colors)
+
+            next_frame += self.frame_interval
+            now = time.monotonic()
+            if now > next_frame:
+                # The bus fell behind, skip the missed frames rather than playing them late
+                missed = int((now - next_frame) / self.frame_interval) + 1
+                self.dropped_frames += missed
+                self.logger.debug(f"dropped {missed} frames")
+                next_frame += missed * self.frame_interval
+            await asyncio.sleep(next_frame - now)
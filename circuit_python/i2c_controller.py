@@ -1,9 +1,8 @@
 import asyncio
-import board
-import busio
 import adafruit_logging as logging
 
 from log import MyHandler
+from command import MAX_GROUPS
 
 
 class PedestalCommand:
@@ -12,105 +11,167 @@ class PedestalCommand:
     GET_STATE = 0x01
     SET_COLOR = 0x02
     SET_BLINKING = 0x03
+    # Sets the groups the pedestal belongs to, as a bitmask of group IDs
+    SET_GROUPS = 0x04
+    # Sent to the general call address, applied by pedestals in any group of the bitmask
+    GROUP_SET_COLOR = 0x05
+    GROUP_SET_BLINKING = 0x06
+
+
+# Every pedestal listens for group commands on the I2C general call address
+GENERAL_CALL_ADDRESS = 0x00
+
+
+# Seconds between background scans for attached and detached pedestals
+SCAN_INTERVAL = 5
+
+# Seconds between verifying the cached state of one pedestal, in round-robin order
+VERIFY_INTERVAL = 1
 
 
 class I2CController:
-    def __init__(self):
+    def __init__(self, i2c=None):
+        """
+        Args:
+            i2c (busio.I2C): The bus the pedestals are attached to, defaulting to the board's I2C pins
+        """
+        if i2c is None:
+            import board
+            import busio
+
+            i2c = busio.I2C(board.SCL, board.SDA)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)  # type: ignore
-        self.logger.addHandler(MyHandler(self.__class__.__name__))
-        self.i2c = busio.I2C(board.SCL, board.SDA)
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
+        self.i2c = i2c
         self.i2c_lock = asyncio.Lock()
+        # The cached bus topology, kept up to date by the background scan and failed transactions
         self.pedestal_addresses = []
+        # The last known (red, green, blue, blinking) state of each pedestal, by address, updated
+        # from the state every pedestal returns after a command
+        self.pedestal_states = {}
+        # The index into the pedestal addresses of the next pedestal to verify
+        self.verify_index = 0
+        # The member addresses of each group, by group ID
+        self.groups = {}
+        asyncio.create_task(self._scan_loop())
+        asyncio.create_task(self._verify_loop())
+
+    async def _scan_loop(self):
+        while True:
+            attached, _ = await self.scan_for_pedestals()
+            # Send newly attached pedestals their groups, which also reads their state right away
+            # rather than waiting for verification
+            if attached:
+                async with self.i2c_lock:
+                    for address in attached:
+                        self.send_i2c_command(
+                            address,
+                            PedestalCommand.SET_GROUPS,
+                            [self._group_mask(address)],
+                            4,
+                        )
+            await asyncio.sleep(SCAN_INTERVAL)
+
+    async def _verify_loop(self):
+        """Refreshes the cached state of one pedestal per tick, in case it changed on its own."""
+        while True:
+            await asyncio.sleep(VERIFY_INTERVAL)
+            if not self.pedestal_addresses:
+                continue
+            self.verify_index = self.verify_index % len(self.pedestal_addresses)
+            address = self.pedestal_addresses[self.verify_index]
+            self.verify_index += 1
+            async with self.i2c_lock:
+                self.send_i2c_command(address, PedestalCommand.GET_STATE, [], 4)
 
     async def scan_for_pedestals(self):
+        """
+        Scans the bus and updates the cached pedestal addresses.
+
+        Returns a tuple of the lists of newly attached and detached addresses.
+        """
         async with self.i2c_lock:
-            if self.i2c.try_lock():
-                self.pedestal_addresses = [
-                    "%x" % address
+            if not self.i2c.try_lock():
+                self.logger.error("Unable to acquire I2C lock in scan_for_pedestals")
+                return [], []
+            try:
+                addresses = [
+                    address
                     for address in self.i2c.scan()
                     if address > 47 and address < 64
                 ]
-                self.logger.debug(f"scanned pedestals: {self.pedestal_addresses}")
+            finally:
                 self.i2c.unlock()
-            else:
-                self.logger.error("Unable to acquire I2C lock in scan_for_pedestals")
 
-    async def get_pedestals(self):
+        attached = [a for a in addresses if a not in self.pedestal_addresses]
+        detached = [a for a in self.pedestal_addresses if a not in addresses]
+        for address in attached:
+            self.logger.info(f"pedestal attached: {address:x}")
+        for address in detached:
+            self.logger.info(f"pedestal detached: {address:x}")
+            self.pedestal_states.pop(address, None)
+        self.pedestal_addresses = addresses
+        return attached, detached
+
+    def get_pedestals(self):
         """
-        Returns the current pedestals found on the I2C bus, in the command format:
-            - I2C address (2 char hex string)
-            - Red value (2 char hex string)
-            - Green value (2 char hex string)
-            - Blue value (2 char hex string)
-            - Blinking state (1 char, 0 or 1)
+        Returns the last known state of the pedestals on the I2C bus, without touching the bus,
+        as tuples of:
+            - I2C address
+            - Red value
+            - Green value
+            - Blue value
+            - Blinking state, either 0 or 1
 
-        Example: ["63AB2E4F0", "649BCC0A1"]
+        Example: [(0x63, 0xAB, 0x2E, 0x4F, 0), (0x64, 0x9B, 0xCC, 0x0A, 1)]
         """
-        await self.scan_for_pedestals()
         pedestals = []
-        async with self.i2c_lock:
-            for address in self.pedestal_addresses:
-                response = self.send_i2c_command(
-                    address, PedestalCommand.GET_STATE, [], 4
-                )
-                if response is None:
-                    continue
-                pedestals.append(
-                    f"{address}"  # Pedestal address, e.g. 62
-                    + f"{response[0]:02x}"  # Red hex, e.g. 1A
-                    + f"{response[1]:02x}"  # Green hex, e.g. 2B
-                    + f"{response[2]:02x}"  # Blue hex, e.g. 3C
-                    + f"{response[3]:d}"  # Blinking state, either 0 or 1
-                )
+        for address in self.pedestal_addresses:
+            state = self.pedestal_states.get(address, None)
+            if state is not None:
+                pedestals.append((address, state[0], state[1], state[2], state[3]))
         return pedestals
 
     async def set_pedestals_color(self, pedestal_colors):
         """
-        Sets the pedestals to the colors provided in the command format:
-            - I2C address (2 char hex string)
-            - Red value (2 char hex string)
-            - Green value (2 char hex string)
-            - Blue value (2 char hex string)
+        Sets the pedestals to the colors provided as tuples of:
+            - I2C address
+            - Red value
+            - Green value
+            - Blue value
 
-        Example: ["63AB2E4F", "649BCC0A"]
+        Example: [(0x63, 0xAB, 0x2E, 0x4F), (0x64, 0x9B, 0xCC, 0x0A)]
 
-        Returns the current pedestals in command format.
+        Returns the current pedestal states.
         """
-        await self.scan_for_pedestals()
-        pedestals = []
         async with self.i2c_lock:
-            for pedestal_color in pedestal_colors:
-                address = pedestal_color[0:2].lower()
+            for address, red, green, blue in pedestal_colors:
                 if address not in self.pedestal_addresses:
                     self.logger.error(
                         "Attempted to set color for address not on I2C bus: %X", address
                     )
                     continue
-                red = int(pedestal_color[2:4], 16)
-                green = int(pedestal_color[4:6], 16)
-                blue = int(pedestal_color[6:8], 16)
-                response = self.send_i2c_command(
+                self.send_i2c_command(
                     address, PedestalCommand.SET_COLOR, [red, green, blue], 4
                 )
-                if response is None:
-                    continue
-        return await self.get_pedestals()
+                # Let other tasks, such as the BLE reader, run between transactions
+                await asyncio.sleep(0)
+        return self.get_pedestals()
 
     async def set_pedestals_blinking(self, pedestal_blinking_states):
-        """Sets the pedestals to blinking states provided in the command format:
-            - I2C address (2 char hex string)
-            - Blinking state (1 char, 0 or 1)
+        """Sets the pedestals to blinking states provided as tuples of:
+            - I2C address
+            - Blinking state, either 0 or 1
 
-        Example: ["631", "640"]
+        Example: [(0x63, 1), (0x64, 0)]
 
-        Returns the current pedestals in command format.
+        Returns the current pedestal states.
         """
-        await self.scan_for_pedestals()
-        pedestals = []
         async with self.i2c_lock:
-            for pedestal_blinking_state in pedestal_blinking_states:
-                address = pedestal_blinking_state[0:2].lower()
+            for address, blinking_state in pedestal_blinking_states:
                 if address not in self.pedestal_addresses:
                     self.logger.error(
                         "Attempted to set blinking for address not on I2C bus: %X",
@@ -118,19 +179,123 @@ class I2CController:
                     )
                     continue
 
-                blinking_state = int(pedestal_blinking_state[2])
-                response = self.send_i2c_command(
+                self.send_i2c_command(
                     address, PedestalCommand.SET_BLINKING, [blinking_state], 4
                 )
-                if response is None:
+                await asyncio.sleep(0)
+        return self.get_pedestals()
+
+    async def define_group(self, group, addresses):
+        """
+        Sets the members of a group, sending each pedestal joining or leaving the group its new
+        group bitmask. A group without members is removed.
+
+        Args:
+            group (int): The group ID, from 0 to MAX_GROUPS - 1
+            addresses (List[int]): The I2C addresses of the members
+
+        Returns the current pedestal states.
+        """
+        if not 0 <= group < MAX_GROUPS:
+            self.logger.error(f"Attempted to define group out of range: {group}")
+            return self.get_pedestals()
+        previous = self.groups.get(group, [])
+        if addresses:
+            self.groups[group] = list(addresses)
+        else:
+            self.groups.pop(group, None)
+        async with self.i2c_lock:
+            for address in set(previous) ^ set(addresses):
+                if address not in self.pedestal_addresses:
                     continue
-        return await self.get_pedestals()
+                self.send_i2c_command(
+                    address, PedestalCommand.SET_GROUPS, [self._group_mask(address)], 4
+                )
+                await asyncio.sleep(0)
+        return self.get_pedestals()
+
+    def _group_mask(self, address):
+        """Returns the bitmask of the groups the pedestal belongs to."""
+        mask = 0
+        for group, addresses in self.groups.items():
+            if address in addresses:
+                mask |= 1 << group
+        return mask
+
+    async def set_group_color(self, group, red, green, blue):
+        """
+        Sets every pedestal in the group to the color, at the same moment.
+
+        Returns the current pedestal states.
+        """
+        members = self._group_members(group)
+        if len(members) == 1:
+            # Addressing a single pedestal is one transaction too, and reads back its state
+            return await self.set_pedestals_color([(members[0], red, green, blue)])
+        if members and await self._send_group_command(
+            PedestalCommand.GROUP_SET_COLOR, [1 << group, red, green, blue]
+        ):
+            # General call writes can't be read back, so assume the members applied it until
+            # they are next read
+            for address in members:
+                state = self.pedestal_states.get(address, None)
+                if state is not None:
+                    self.pedestal_states[address] = (red, green, blue, state[3])
+        return self.get_pedestals()
+
+    async def set_group_blinking(self, group, blinking_state):
+        """
+        Sets the blinking state of every pedestal in the group, at the same moment.
+
+        Returns the current pedestal states.
+        """
+        members = self._group_members(group)
+        if len(members) == 1:
+            return await self.set_pedestals_blinking([(members[0], blinking_state)])
+        if members and await self._send_group_command(
+            PedestalCommand.GROUP_SET_BLINKING, [1 << group, blinking_state]
+        ):
+            for address in members:
+                state = self.pedestal_states.get(address, None)
+                if state is not None:
+                    self.pedestal_states[address] = state[:3] + (blinking_state,)
+        return self.get_pedestals()
+
+    def _group_members(self, group):
+        """Returns the addresses of the group's members on the bus."""
+        return [
+            address
+            for address in self.groups.get(group, [])
+            if address in self.pedestal_addresses
+        ]
+
+    async def _send_group_command(self, command, data):
+        """
+        Writes a group command to every pedestal with a single general call transaction.
+
+        Returns True if the write succeeded.
+        """
+        async with self.i2c_lock:
+            if not self.i2c.try_lock():
+                self.logger.error("Unable to acquire I2C lock in _send_group_command")
+                return False
+            try:
+                self.i2c.writeto(GENERAL_CALL_ADDRESS, bytearray([command] + data))
+            except (RuntimeError, OSError) as e:
+                self.logger.error(f"Failed i2c general call for command {command}: {e}")
+                return False
+            finally:
+                self.i2c.unlock()
+        return True
 
     def send_i2c_command(self, address, command, data, response_length):
         """Sends a command via an I2C transaction.
 
+        Every pedestal command responds with the pedestal's state after the command is applied,
+        which is recorded as the pedestal's last known state.
+
         Args:
-            address (String): Hex I2C peripheral address
+            address (int): I2C peripheral address
             command (PeripheralCommand): The command to send
             data (List[int]): Data to send with the command, or an empty list
             response_length (int): The expected number of bytes to receive from the peripheral
@@ -144,19 +309,30 @@ class I2CController:
         try:
             if self.i2c.try_lock():
                 self.logger.debug(f"I2C write: out_buffer {[i for i in out_buffer]}")
-                self.i2c.writeto(int(address, 16), out_buffer)
-                self.i2c.readfrom_into(int(address, 16), in_buffer)
+                # A repeated start rather than a stop before the read, so the pedestal applies
+                # the command from its request handler alone, see requestEvent in pedestal.ino
+                self.i2c.writeto_then_readfrom(address, out_buffer, in_buffer)
                 self.logger.debug(f"I2C read: in_buffer {[i for i in in_buffer]}")
             else:
                 self.logger.error("Unable to acquire I2C lock in send_i2c_command")
+                return None
         except (RuntimeError, OSError) as e:
             self.logger.error(
-                f"Failed i2c for command {command} to address {address}",
+                f"Failed i2c for command {command} to address {address:x}",
             )
+            # Treat the pedestal as detached until the background scan finds it again
             self.pedestal_addresses = [
                 a for a in self.pedestal_addresses if a != address
             ]
+            self.pedestal_states.pop(address, None)
             return None
         finally:
             self.i2c.unlock()
+        if response_length == 4 and in_buffer[3] in (0, 1):
+            self.pedestal_states[address] = (
+                in_buffer[0],
+                in_buffer[1],
+                in_buffer[2],
+                in_buffer[3],
+            )
         return in_buffer
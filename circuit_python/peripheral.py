@@ -1,134 +1,270 @@
 import asyncio
+import time
 import adafruit_logging as logging
-from adafruit_ble import BLERadio
-from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
-from adafruit_ble.services.nordic import UARTService
 
 from log import MyHandler
-from command import CommandType, Command, int_to_ascii_byte, parse_command
+from command import (
+    CommandType,
+    Command,
+    Protocol,
+    PacketDecoder,
+    encode_packet,
+    hash_pedestal_states,
+    negotiate_protocol,
+)
 from i2c_controller import I2CController
+from effects import EffectEngine
+
+# Seconds to wait between checks for received data, letting other tasks run
+READ_INTERVAL = 0.005
+
+# Seconds without receiving any packet before probing the central with a healthcheck
+HEALTHCHECK_QUIET_PERIOD = 2
+# Seconds between healthcheck probes while the link stays quiet
+HEALTHCHECK_PROBE_INTERVAL = 1
+# Seconds without receiving any packet before the link is considered dead
+LIVENESS_DEADLINE = 4
+
+# Seconds between checks for pedestal state changes to push to the central
+NOTIFY_INTERVAL = 0.5
+
+# Commands that require I2C transactions, handled one at a time by the I2C worker
+I2C_COMMANDS = (
+    Command.SET_PEDESTALS_COLOR,
+    Command.BLINK_PEDESTALS,
+    Command.STOP_PEDESTALS_BLINKING,
+    # Queued with the bus work so effects and colors apply in the order they were sent
+    Command.SET_PEDESTALS_EFFECT,
+    Command.DEFINE_GROUP,
+    Command.SET_GROUP_COLOR,
+    Command.SET_GROUP_BLINKING,
+)
 
 
 class BLEClient:
-    def __init__(self):
-        self.ble = BLERadio()
-        self.uart = UARTService()
-        self.advertisement = ProvideServicesAdvertisement(self.uart)
-        self.i2c_controller = I2CController()
+    def __init__(self, transport=None, i2c_controller=None):
+        """
+        Args:
+            transport: Carries bytes to and from the central, defaulting to BLE. See BLETransport.
+            i2c_controller (I2CController): Controls the pedestals, defaulting to the board's I2C bus
+        """
+        if transport is None:
+            from peripheral_transport import BLETransport
+
+            transport = BLETransport()
+        self.transport = transport
+        self.i2c_controller = (
+            i2c_controller if i2c_controller is not None else I2CController()
+        )
+        # Animates pedestals on the hub, so effects keep running without the central
+        self.effect_engine = EffectEngine(self.i2c_controller)
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)  # type: ignore
-        self.logger.addHandler(MyHandler(self.__class__.__name__))
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
         self.healthcheck_task = None
-        self.healthcheck_num_failed = 0
+        # When a packet was last received, any packet showing the central is alive
+        self.last_received = time.monotonic()
         self.pending_commands = {}
         self.packet_id = 0
+        self.decoder = PacketDecoder()
+        # Packets are sent as ASCII until the central negotiates a newer protocol
+        self.protocol = Protocol.ASCII
+        # Requests waiting on the I2C worker, as (id, command, data) tuples
+        self.i2c_jobs = []
+        self.i2c_jobs_ready = asyncio.Event()
+        self.i2c_worker_task = None
+        # The pedestal states last sent to the central, None until the central first asks
+        self.reported_pedestals = None
+        self.notify_task = None
 
     async def connect(self):
-        if not self.ble.connected:
+        if not self.transport.connected:
             self.logger.info("starting advertising")
-            self.ble.start_advertising(self.advertisement)
-            while not self.ble.connected:
-                await asyncio.sleep(0)
+            await self.transport.connect()
             self.logger.info("connected")
-            self.ble.stop_advertising()
+            self.last_received = time.monotonic()
             asyncio.create_task(self._read())
+            self.i2c_worker_task = asyncio.create_task(self._i2c_worker())
             self.healthcheck_task = asyncio.create_task(self._healthcheck())
+            self.notify_task = asyncio.create_task(self._notify_changes())
 
-    def write(self, data):
-        self.logger.debug("TX: %s", data)
-        if self.ble.connected:
-            self.uart.write(data + "\n")
+    def write(self, packet):
+        self.logger.debug("TX: %s", packet)
+        self.transport.write(packet)
 
     async def _reset(self):
-        for conn in self.ble.connections:
-            if conn is not None:
-                conn.disconnect()
+        self.transport.disconnect()
         self.pending_commands = {}
+        self.decoder = PacketDecoder()
+        self.protocol = Protocol.ASCII
+        self.i2c_jobs = []
+        self.reported_pedestals = None
+        if self.i2c_worker_task is not None:
+            self.i2c_worker_task.cancel()
         if self.healthcheck_task is not None:
             self.healthcheck_task.cancel()
-        self.healthcheck_num_failed = 0
+        if self.notify_task is not None:
+            self.notify_task.cancel()
         asyncio.create_task(self.connect())
 
     async def _read(self):
-        while self.ble.connected:
-            l = await self._read_line()
-            if l:
-                self.logger.debug("RX: %s", l)
-                command_type, id, command, data = parse_command(l)
+        while self.transport.connected:
+            packets = self._read_packets()
+            if packets:
+                self.last_received = time.monotonic()
+            for packet in packets:
+                self.logger.debug("RX: %s", packet)
+                command_type, id, command, data = packet
                 if command_type == CommandType.RESPONSE:
-                    callback = self.pending_commands.get(id, None)
-                    if callback:
-                        callback(command, data)
+                    if id in self.pending_commands:
+                        callback = self.pending_commands.pop(id)
+                        if callback:
+                            callback(command, data)
                     else:
                         self.logger.error(
                             "no callback for id: "
-                            + id
+                            + str(id)
                             + " "
                             + str(self.pending_commands)
                         )
+                elif command in I2C_COMMANDS:
+                    # Queue bus work so the reader stays free to answer cheap commands
+                    self.i2c_jobs.append((id, command, data))
+                    self.i2c_jobs_ready.set()
                 else:
-                    if command == Command.HEALTHCHECK:
-                        await self.send_command_response(id, command)
-                    if command == Command.GET_PEDESTALS:
-                        pedestals = await self.i2c_controller.get_pedestals()
-                        await self.send_command_response(id, command, *pedestals)
-                    if command == Command.SET_PEDESTALS_COLOR:
-                        pedestals = await self.i2c_controller.set_pedestals_color(data)
-                        await self.send_command_response(id, command, *pedestals)
-                    if command == Command.BLINK_PEDESTALS:
-                        data = [address + "1" for address in data]
-                        pedestals = await self.i2c_controller.set_pedestals_blinking(
-                            data
-                        )
-                        await self.send_command_response(id, command, *pedestals)
-                    if command == Command.STOP_PEDESTALS_BLINKING:
-                        data = [address + "0" for address in data]
-                        pedestals = await self.i2c_controller.set_pedestals_blinking(
-                            data
-                        )
-                        await self.send_command_response(id, command, *pedestals)
+                    await self._handle_request(id, command, data)
+            await asyncio.sleep(READ_INTERVAL)
 
         self.logger.info("no longer connected, reconnecting")
         asyncio.create_task(self._reset())
 
-    async def _read_line(self):
-        if self.uart.in_waiting > 0:
-            l = self.uart.readline()
-            if l != b"" and l is not None:
-                l = l.decode("utf-8").strip("\n")
-                return l
+    async def _handle_request(self, id, command, data):
+        """Responds to requests that don't touch the I2C bus."""
+        if command == Command.HEALTHCHECK:
+            await self.send_command_response(id, command)
+        if command == Command.NEGOTIATE_PROTOCOL:
+            # Respond using the current protocol, then switch for subsequent packets
+            protocol = negotiate_protocol(data)
+            await self.send_command_response(id, command, protocol)
+            self.protocol = protocol
+            self.logger.info(f"using protocol version {protocol}")
+        if command == Command.GET_PEDESTALS:
+            pedestals = self.i2c_controller.get_pedestals()
+            self.reported_pedestals = pedestals
+            # A central sending the hash of the state it knows only needs to hear about changes
+            if len(data) == 4 and list(data) == hash_pedestal_states(pedestals):
+                await self.send_command_response(id, Command.PEDESTALS_NOT_MODIFIED)
+            else:
+                await self.send_command_response(id, command, *pedestals)
+
+    async def _i2c_worker(self):
+        """Runs queued I2C requests in order, responding as each one finishes."""
+        while True:
+            await self.i2c_jobs_ready.wait()
+            self.i2c_jobs_ready.clear()
+            while self.i2c_jobs:
+                id, command, data = self.i2c_jobs.pop(0)
+                try:
+                    pedestals = await self._run_i2c_job(command, data)
+                    if pedestals is None:
+                        self.logger.error(
+                            f"malformed data for command {command}: {data}"
+                        )
+                except Exception as e:
+                    # Keep the worker alive so later commands still reach the bus
+                    self.logger.error(f"failed to run command {command}: {e}")
+                    pedestals = None
+                if pedestals is None:
+                    # Respond with the known state so the central's request still resolves
+                    pedestals = self.i2c_controller.get_pedestals()
+                self.reported_pedestals = pedestals
+                await self.send_command_response(id, command, *pedestals)
+
+    async def _run_i2c_job(self, command, data):
+        """Runs a single I2C request, returning the pedestal states or None if malformed."""
+        if command == Command.SET_PEDESTALS_COLOR:
+            # A color set explicitly replaces any running effect
+            self.effect_engine.stop([color[0] for color in data])
+            return await self.i2c_controller.set_pedestals_color(data)
+        if command == Command.BLINK_PEDESTALS:
+            data = [(address, 1) for address in data]
+            return await self.i2c_controller.set_pedestals_blinking(data)
+        if command == Command.STOP_PEDESTALS_BLINKING:
+            data = [(address, 0) for address in data]
+            return await self.i2c_controller.set_pedestals_blinking(data)
+        if command == Command.SET_PEDESTALS_EFFECT:
+            duration, easing, loop, addresses, keyframes = data
+            self.effect_engine.start(addresses, duration, easing, loop, keyframes)
+            return self.i2c_controller.get_pedestals()
+        # The packet decoder doesn't check the number of group command values
+        if command == Command.DEFINE_GROUP and len(data) >= 1:
+            return await self.i2c_controller.define_group(data[0], data[1:])
+        if command == Command.SET_GROUP_COLOR and len(data) == 4:
+            group, red, green, blue = data
+            # A color set explicitly replaces any running effect
+            self.effect_engine.stop(self.i2c_controller.groups.get(group, []))
+            return await self.i2c_controller.set_group_color(group, red, green, blue)
+        if command == Command.SET_GROUP_BLINKING and len(data) == 2:
+            group, blinking = data
+            return await self.i2c_controller.set_group_blinking(group, blinking)
         return None
 
+    async def _notify_changes(self):
+        """
+        Pushes the pedestal states to the central when they change without a command, such as a
+        pedestal being attached or detached, or an effect running, so the central doesn't need to
+        poll for changes.
+
+        Only centrals that have asked for the pedestal states and negotiated the binary protocol
+        are sent notifications, older centrals don't expect requests other than healthchecks.
+        """
+        while True:
+            await asyncio.sleep(NOTIFY_INTERVAL)
+            if self.reported_pedestals is None or self.protocol < Protocol.BINARY:
+                continue
+            pedestals = self.i2c_controller.get_pedestals()
+            if pedestals != self.reported_pedestals:
+                self.reported_pedestals = pedestals
+                await self.send_command_request(Command.PEDESTALS_CHANGED, *pedestals)
+
+    def _read_packets(self):
+        return self.decoder.feed(self.transport.read())
+
     async def send_command_request(self, command, *data, response_handler=None):
-        if self.ble.connected:
-            packet_id = int_to_ascii_byte(self.packet_id)
-            id = "{}{}".format(CommandType.REQUEST, packet_id)
-            packet = "{}|{}|{}".format(id, int_to_ascii_byte(command), "#".join(data))
+        if self.transport.connected:
+            packet_id = self.packet_id
             self.pending_commands[packet_id] = response_handler
-            self.packet_id = self.packet_id + 1
-            self.write(packet)
+            self.packet_id = (self.packet_id + 1) % 256
+            self.write(
+                encode_packet(
+                    self.protocol, CommandType.REQUEST, packet_id, command, data
+                )
+            )
 
     async def send_command_response(self, id, command, *data):
-        if self.ble.connected:
-            packet = "{}|{}|{}".format(
-                CommandType.RESPONSE + id, int_to_ascii_byte(command), "#".join(data)
+        if self.transport.connected:
+            self.write(
+                encode_packet(self.protocol, CommandType.RESPONSE, id, command, data)
             )
-            self.write(packet)
-
-    def on_healthcheck_response(self, command, data):
-        self.healthcheck_num_failed = 0
 
     async def _healthcheck(self):
-        # Let the connection settle for a few seconds
-        await asyncio.sleep(3)
-
+        """
+        Tracks liveness from received packets, probing the central only when the link is quiet.
+        """
         while True:
-            # Pessimistically set failed to have healthcheck responder reset to 0 on success
-            self.healthcheck_num_failed += 1
-            await self.send_command_request(
-                Command.HEALTHCHECK, response_handler=self.on_healthcheck_response
-            )
-            if self.healthcheck_num_failed > 2:
+            quiet = time.monotonic() - self.last_received
+            if quiet >= LIVENESS_DEADLINE:
                 self.logger.error("failed healthcheck")
-                asyncio.create_task(self._reset())
-            await asyncio.sleep(1)
+                # The reader notices the dropped link and resets, so only one reset runs
+                self.transport.disconnect()
+                return
+            if quiet >= HEALTHCHECK_QUIET_PERIOD:
+                # The response is handled like any other packet, moving the deadline
+                await self.send_command_request(Command.HEALTHCHECK)
+                await asyncio.sleep(
+                    min(HEALTHCHECK_PROBE_INTERVAL, LIVENESS_DEADLINE - quiet)
+                )
+            else:
+                await asyncio.sleep(HEALTHCHECK_QUIET_PERIOD - quiet)
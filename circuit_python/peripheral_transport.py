@@ -0,0 +1,56 @@
+import asyncio
+from adafruit_ble import BLERadio
+from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
+from adafruit_ble.services.nordic import UARTService
+
+
+class BLETransport:
+    """
+    Carries bytes to and from the central over the BLE UART service.
+
+    Transports provide:
+        - connected: Whether the link is up
+        - connect(): Waits for a central to connect
+        - write(packet): Sends bytes to the central
+        - read(): Returns any bytes received from the central without waiting, or b""
+        - disconnect(): Takes the link down
+    """
+
+    def __init__(self, name=None):
+        """
+        Args:
+            name (str): The BLE name to advertise, which identifies the hub when the central
+                connects to several hubs. Only about 8 characters fit in the advertisement
+                alongside the UART service.
+        """
+        self.ble = BLERadio()
+        if name is not None:
+            self.ble.name = name
+        self.uart = UARTService()
+        self.advertisement = ProvideServicesAdvertisement(self.uart)
+        if name is not None:
+            self.advertisement.complete_name = name
+
+    @property
+    def connected(self):
+        return self.ble.connected
+
+    async def connect(self):
+        self.ble.start_advertising(self.advertisement)
+        while not self.ble.connected:
+            await asyncio.sleep(0)
+        self.ble.stop_advertising()
+
+    def write(self, packet):
+        if self.ble.connected:
+            self.uart.write(packet)
+
+    def read(self):
+        if self.uart.in_waiting > 0:
+            return self.uart.read(self.uart.in_waiting)
+        return b""
+
+    def disconnect(self):
+        for conn in self.ble.connections:
+            if conn is not None:
+                conn.disconnect()
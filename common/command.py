@@ -9,6 +9,99 @@ class Command:
     SET_PEDESTALS_COLOR = 2
     BLINK_PEDESTALS = 3
     STOP_PEDESTALS_BLINKING = 4
+    NEGOTIATE_PROTOCOL = 5
+    SET_PEDESTALS_EFFECT = 6
+    # Sent by the hub to the central when pedestal state changes without a command
+    PEDESTALS_CHANGED = 7
+    DEFINE_GROUP = 8
+    SET_GROUP_COLOR = 9
+    SET_GROUP_BLINKING = 10
+    # Sent by the hub in response to GET_PEDESTALS when the state matches the central's hash
+    PEDESTALS_NOT_MODIFIED = 11
+
+
+class Protocol:
+    """Versions of the packet framing, negotiated after connecting."""
+
+    # Newline delimited ID-command-data packets of ASCII hex
+    ASCII = 1
+    # Length prefixed frames of packed bytes
+    BINARY = 2
+
+
+# Pedestal groups per hub, each a bit of the pedestals' one byte group bitmask
+MAX_GROUPS = 8
+
+# Protocol versions supported by this implementation, most preferred first
+SUPPORTED_PROTOCOLS = [Protocol.BINARY, Protocol.ASCII]
+
+# Marks the start of a binary frame, never the first byte of an ASCII packet
+FRAME_START = 0x02
+
+# Bytes in a binary frame following the length byte, before the payload
+FRAME_HEADER_LENGTH = 3
+
+# The largest binary frame payload that fits in the one byte length
+MAX_FRAME_PAYLOAD_LENGTH = 255 - FRAME_HEADER_LENGTH
+
+# Set on the address byte of a binary pedestal state record if the pedestal is blinking
+BLINKING_FLAG = 0x80
+
+
+class Easing:
+    """Curves for interpolating between effect keyframes."""
+
+    LINEAR = 0
+    EASE_IN = 1
+    EASE_OUT = 2
+    EASE_IN_OUT = 3
+
+
+class Payload:
+    """The data format of a command, which determines how it is encoded."""
+
+    # A list of one byte integers, e.g. pedestal addresses
+    BYTES = 0
+    # A list of (address, red, green, blue) tuples
+    COLORS = 1
+    # A list of (address, red, green, blue, blinking) tuples
+    STATES = 2
+    # An effect as duration in milliseconds, easing, loop (0 or 1), a list of addresses, and a
+    # list of (position, red, green, blue) keyframes with positions from 0 to 255
+    EFFECT = 3
+
+
+REQUEST_PAYLOADS = {
+    Command.HEALTHCHECK: Payload.BYTES,
+    Command.GET_PEDESTALS: Payload.BYTES,
+    Command.SET_PEDESTALS_COLOR: Payload.COLORS,
+    Command.BLINK_PEDESTALS: Payload.BYTES,
+    Command.STOP_PEDESTALS_BLINKING: Payload.BYTES,
+    Command.NEGOTIATE_PROTOCOL: Payload.BYTES,
+    Command.SET_PEDESTALS_EFFECT: Payload.EFFECT,
+    Command.PEDESTALS_CHANGED: Payload.STATES,
+    # The group ID, then the member addresses
+    Command.DEFINE_GROUP: Payload.BYTES,
+    # The group ID, then the red, green, and blue values
+    Command.SET_GROUP_COLOR: Payload.BYTES,
+    # The group ID, then the blinking state
+    Command.SET_GROUP_BLINKING: Payload.BYTES,
+}
+
+RESPONSE_PAYLOADS = {
+    Command.HEALTHCHECK: Payload.BYTES,
+    Command.GET_PEDESTALS: Payload.STATES,
+    Command.SET_PEDESTALS_COLOR: Payload.STATES,
+    Command.BLINK_PEDESTALS: Payload.STATES,
+    Command.STOP_PEDESTALS_BLINKING: Payload.STATES,
+    Command.NEGOTIATE_PROTOCOL: Payload.BYTES,
+    Command.SET_PEDESTALS_EFFECT: Payload.STATES,
+    Command.PEDESTALS_CHANGED: Payload.BYTES,
+    Command.DEFINE_GROUP: Payload.STATES,
+    Command.SET_GROUP_COLOR: Payload.STATES,
+    Command.SET_GROUP_BLINKING: Payload.STATES,
+    Command.PEDESTALS_NOT_MODIFIED: Payload.BYTES,
+}
 
 
 def int_to_ascii_byte(i):
@@ -29,3 +122,281 @@ def parse_command(raw):
         data = raw_data.split("#")
 
     return command_type, id, command, data
+
+
+def negotiate_protocol(versions):
+    """Returns the most preferred supported protocol version of those provided."""
+    for version in SUPPORTED_PROTOCOLS:
+        if version in versions:
+            return version
+    return Protocol.ASCII
+
+
+def hash_pedestal_states(states):
+    """
+    Returns a Fletcher-32 checksum of (address, red, green, blue, blinking) pedestal state
+    tuples, as a list of 4 bytes most significant first. The central sends it with GET_PEDESTALS
+    so the hub can reply that the state is unchanged rather than resending it.
+    """
+    sum1, sum2 = 0, 0
+    for address, red, green, blue, blinking in states:
+        for value in (address, red, green, blue, 1 if blinking else 0):
+            # Every intermediate value stays small, which is cheap on the hub
+            sum1 = (sum1 + value) % 65535
+            sum2 = (sum2 + sum1) % 65535
+    return [sum2 >> 8, sum2 & 0xFF, sum1 >> 8, sum1 & 0xFF]
+
+
+def _payload(command_type, command):
+    if command_type == CommandType.REQUEST:
+        return REQUEST_PAYLOADS.get(command, None)
+    return RESPONSE_PAYLOADS.get(command, None)
+
+
+def encode_packet(protocol, command_type, id, command, data=()):
+    """
+    Encodes a packet in the provided protocol.
+
+    Args:
+        protocol (Protocol): The protocol version to encode with
+        command_type (CommandType): Whether the packet is a request or response
+        id (int): The packet ID
+        command (Command): The command
+        data (List): The command data, in the format defined by the command's payload
+
+    Returns:
+        The encoded packet as bytes.
+    """
+    payload = _payload(command_type, command)
+    if protocol == Protocol.BINARY:
+        return _encode_frame(command_type, id, command, payload, data)
+    return "{}{}|{}|{}\n".format(
+        command_type,
+        int_to_ascii_byte(id),
+        int_to_ascii_byte(command),
+        "#".join(_encode_ascii_data(payload, data)),
+    ).encode("utf-8")
+
+
+def _encode_ascii_data(payload, data):
+    if payload == Payload.STATES:
+        return [
+            "{:02x}{:02x}{:02x}{:02x}{:d}".format(address, red, green, blue, blinking)
+            for address, red, green, blue, blinking in data
+        ]
+    if payload == Payload.COLORS:
+        return [
+            "{:02x}{:02x}{:02x}{:02x}".format(address, red, green, blue)
+            for address, red, green, blue in data
+        ]
+    if payload == Payload.BYTES:
+        return [int_to_ascii_byte(value) for value in data]
+    if payload == Payload.EFFECT:
+        duration, easing, loop, addresses, keyframes = data
+        return [
+            "{:04x}".format(duration),
+            int_to_ascii_byte(easing),
+            int_to_ascii_byte(loop),
+            "".join(int_to_ascii_byte(address) for address in addresses),
+            "".join(
+                "{:02x}{:02x}{:02x}{:02x}".format(position, red, green, blue)
+                for position, red, green, blue in keyframes
+            ),
+        ]
+    return data
+
+
+def _encode_frame(command_type, id, command, payload, data):
+    if payload == Payload.STATES or payload == Payload.COLORS:
+        length = 4 * len(data)
+    elif payload == Payload.EFFECT:
+        # Duration, easing, loop, and the address count, then addresses and keyframes
+        length = 5 + len(data[3]) + 4 * len(data[4])
+    else:
+        length = len(data)
+    if length > MAX_FRAME_PAYLOAD_LENGTH:
+        raise ValueError("frame payload too long: {}".format(length))
+
+    frame = bytearray(2 + FRAME_HEADER_LENGTH + length)
+    frame[0] = FRAME_START
+    frame[1] = FRAME_HEADER_LENGTH + length
+    frame[2] = 1 if command_type == CommandType.RESPONSE else 0
+    frame[3] = id
+    frame[4] = command
+    i = 2 + FRAME_HEADER_LENGTH
+    if payload == Payload.STATES:
+        for address, red, green, blue, blinking in data:
+            frame[i] = address | (BLINKING_FLAG if blinking else 0)
+            frame[i + 1] = red
+            frame[i + 2] = green
+            frame[i + 3] = blue
+            i += 4
+    elif payload == Payload.COLORS:
+        for address, red, green, blue in data:
+            frame[i] = address
+            frame[i + 1] = red
+            frame[i + 2] = green
+            frame[i + 3] = blue
+            i += 4
+    elif payload == Payload.EFFECT:
+        duration, easing, loop, addresses, keyframes = data
+        frame[i] = duration >> 8
+        frame[i + 1] = duration & 0xFF
+        frame[i + 2] = easing
+        frame[i + 3] = loop
+        frame[i + 4] = len(addresses)
+        i += 5
+        for address in addresses:
+            frame[i] = address
+            i += 1
+        for position, red, green, blue in keyframes:
+            frame[i] = position
+            frame[i + 1] = red
+            frame[i + 2] = green
+            frame[i + 3] = blue
+            i += 4
+    else:
+        frame[i:] = bytes(data)
+    return bytes(frame)
+
+
+class PacketDecoder:
+    """
+    Incrementally decodes packets from bytes read off the link.
+
+    Both protocols are decoded regardless of which was negotiated, so packets already in flight
+    when the protocol changes are still understood. Binary frames are decoded in place through a
+    memoryview, without copying the payload.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def feed(self, chunk):
+        """
+        Appends bytes read from the link.
+
+        Returns:
+            A list of complete (command_type, id, command, data) packets, where data is in the
+            format defined by the command's payload.
+        """
+        if not chunk:
+            return []
+        self.buffer += chunk
+        view = memoryview(self.buffer)
+        length = len(self.buffer)
+        packets = []
+        start = 0
+        while start < length:
+            if view[start] == FRAME_START:
+                if length - start < 2:
+                    break
+                end = start + 2 + view[start + 1]
+                if end > length:
+                    break
+                if end - start >= 2 + FRAME_HEADER_LENGTH:
+                    packet = _decode_frame(view[start + 2 : end])
+                    if packet is not None:
+                        packets.append(packet)
+                start = end
+            else:
+                newline = bytes(view[start:]).find(b"\n")
+                if newline == -1:
+                    break
+                if newline > 0:
+                    packet = _decode_line(bytes(view[start : start + newline]))
+                    if packet is not None:
+                        packets.append(packet)
+                start += newline + 1
+        if start > 0:
+            self.buffer = self.buffer[start:]
+        return packets
+
+
+def _decode_line(raw):
+    """Decodes an ASCII packet, returning None if it is malformed."""
+    try:
+        command_type, id, command, data = parse_command(raw.decode("utf-8").strip())
+        payload = _payload(command_type, command)
+        if payload == Payload.STATES:
+            data = [
+                (
+                    int(d[0:2], 16),
+                    int(d[2:4], 16),
+                    int(d[4:6], 16),
+                    int(d[6:8], 16),
+                    int(d[8]),
+                )
+                for d in data
+            ]
+        elif payload == Payload.COLORS:
+            data = [
+                (int(d[0:2], 16), int(d[2:4], 16), int(d[4:6], 16), int(d[6:8], 16))
+                for d in data
+            ]
+        elif payload == Payload.BYTES:
+            data = [int(d, 16) for d in data]
+        elif payload == Payload.EFFECT:
+            addresses, keyframes = data[3], data[4]
+            data = [
+                int(data[0], 16),
+                int(data[1], 16),
+                int(data[2], 16),
+                [int(addresses[i : i + 2], 16) for i in range(0, len(addresses), 2)],
+                [
+                    (
+                        int(keyframes[i : i + 2], 16),
+                        int(keyframes[i + 2 : i + 4], 16),
+                        int(keyframes[i + 4 : i + 6], 16),
+                        int(keyframes[i + 6 : i + 8], 16),
+                    )
+                    for i in range(0, len(keyframes), 8)
+                ],
+            ]
+        return command_type, int(id, 16), command, data
+    except (IndexError, ValueError):
+        return None
+
+
+def _decode_frame(frame):
+    """Decodes a binary frame, excluding the start and length bytes, or None if it is malformed."""
+    command_type = CommandType.RESPONSE if frame[0] else CommandType.REQUEST
+    id = frame[1]
+    command = frame[2]
+    payload = _payload(command_type, command)
+    view = frame[FRAME_HEADER_LENGTH:]
+    if payload == Payload.STATES:
+        data = [
+            (
+                view[i] & ~BLINKING_FLAG,
+                view[i + 1],
+                view[i + 2],
+                view[i + 3],
+                1 if view[i] & BLINKING_FLAG else 0,
+            )
+            for i in range(0, len(view) - 3, 4)
+        ]
+    elif payload == Payload.COLORS:
+        data = [
+            (view[i], view[i + 1], view[i + 2], view[i + 3])
+            for i in range(0, len(view) - 3, 4)
+        ]
+    elif payload == Payload.BYTES:
+        data = list(view)
+    elif payload == Payload.EFFECT:
+        if len(view) < 5 or len(view) < 5 + view[4]:
+            return None
+        keyframes_start = 5 + view[4]
+        data = [
+            (view[0] << 8) | view[1],
+            view[2],
+            view[3],
+            list(view[5:keyframes_start]),
+            [
+                (view[i], view[i + 1], view[i + 2], view[i + 3])
+                for i in range(keyframes_start, len(view) - 3, 4)
+            ],
+        ]
+    else:
+        data = bytes(view)
+    return command_type, id, command, data
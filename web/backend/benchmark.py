@@ -0,0 +1,233 @@
+"""
+Benchmarks the backend end to end against a simulated hub.
+
+Runs the aiohttp app from main.main() with the simulator enabled in its own thread and event
+loop, then drives it with websocket clients issuing commands the way the web app does. For each
+number of clients, reports round-trip latency percentiles per command, commands per second, the
+server's event loop lag, and server CPU time per client. Also runs microbenchmarks of packet
+parsing. Results are written as JSON so runs can be compared for regressions.
+
+Usage:
+    PYTHONPATH=../../common python benchmark.py --clients 1 10 50 --duration 10
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import statistics
+import threading
+import time
+import timeit
+
+import aiohttp
+from aiohttp import web
+
+import main
+from command import (
+    Command,
+    CommandType,
+    PacketDecoder,
+    Protocol,
+    encode_packet,
+    parse_command,
+)
+from pedestal_cache import parse_pedestal_states
+
+# Websocket methods sent by each client, in rotation
+CLIENT_METHODS = ["setPedestalsColor", "blinkPedestals", "stopPedestalsBlinking"]
+
+# Seconds between samples of the server's event loop lag
+LAG_INTERVAL = 0.05
+
+
+class ServerThread:
+    """Runs the backend app in its own thread and event loop, measuring loop lag and CPU time."""
+
+    def __init__(self, port):
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self.ready = threading.Event()
+        self.lags = []
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        self.ready.wait()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._start_app())
+        self.ready.set()
+        self.loop.run_forever()
+
+    async def _start_app(self):
+        self.runner = web.AppRunner(main.main())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, "127.0.0.1", self.port).start()
+        self.loop.create_task(self._measure_lag())
+
+    async def _measure_lag(self):
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(LAG_INTERVAL)
+            self.lags.append(self.loop.time() - start - LAG_INTERVAL)
+
+    async def _thread_time(self):
+        return time.thread_time()
+
+    def cpu_time(self):
+        """Returns the CPU seconds used by the server thread."""
+        return asyncio.run_coroutine_threadsafe(self._thread_time(), self.loop).result()
+
+
+async def run_client(session, url, addresses, deadline, think_time, latencies):
+    """Sends commands until the deadline, recording round trip seconds per method."""
+    async with session.ws_connect(url) as socket:
+        i = 0
+        while time.monotonic() < deadline:
+            method = CLIENT_METHODS[i % len(CLIENT_METHODS)]
+            i += 1
+            address = random.choice(addresses)
+            if method == "setPedestalsColor":
+                data = [{"address": address, "color": "%06x" % random.getrandbits(24)}]
+            else:
+                data = [address]
+            start = time.monotonic()
+            # Forced so repeated blinking states still go to the hub, measuring BLE round trips
+            await socket.send_json({"method": method, "data": data, "force": True})
+            # Skip broadcast updates until the reply arrives
+            async for message in socket:
+                if json.loads(message.data).get("method") == method:
+                    break
+            latencies[method].append(time.monotonic() - start)
+            await asyncio.sleep(think_time)
+
+
+async def run_scenario(server, num_clients, duration, think_time):
+    url = f"http://127.0.0.1:{server.port}/websocket?mode=delta"
+    addresses = [
+        "%s:%02x" % (hub_id, 0x30 + i)
+        for hub_id in main.HUBS
+        for i in range(main.SIMULATOR_OPTIONS["num_pedestals"])
+    ]
+    latencies = {method: [] for method in CLIENT_METHODS}
+    server.lags.clear()
+    cpu_start = server.cpu_time()
+    async with aiohttp.ClientSession() as session:
+        deadline = time.monotonic() + duration
+        await asyncio.gather(
+            *[
+                run_client(session, url, addresses, deadline, think_time, latencies)
+                for _ in range(num_clients)
+            ]
+        )
+    cpu = server.cpu_time() - cpu_start
+    lags = list(server.lags)
+    num_commands = sum(len(l) for l in latencies.values())
+    return {
+        "clients": num_clients,
+        "commands_per_second": num_commands / duration,
+        "latency": {
+            method: summarize(values) for method, values in latencies.items()
+        },
+        "event_loop_lag": summarize(lags),
+        "server_cpu_seconds": cpu,
+        "server_cpu_seconds_per_client": cpu / num_clients,
+    }
+
+
+def summarize(values):
+    """Returns the count, p50, and p99 of the values."""
+    if len(values) < 2:
+        return {"count": len(values), "p50": None, "p99": None}
+    percentiles = statistics.quantiles(values, n=100, method="inclusive")
+    return {"count": len(values), "p50": percentiles[49], "p99": percentiles[98]}
+
+
+def run_microbenchmarks(number):
+    """Returns the seconds per call of packet encoding and parsing, for 16 pedestals."""
+    states = [(0x30 + i, 0xFF, 0xE6, i, i % 2) for i in range(16)]
+    results = {}
+    for name, protocol in (("ascii", Protocol.ASCII), ("binary", Protocol.BINARY)):
+        packet = encode_packet(
+            protocol, CommandType.RESPONSE, 1, Command.GET_PEDESTALS, states
+        )
+        results[f"encode_get_pedestals_{name}"] = (
+            timeit.timeit(
+                lambda: encode_packet(
+                    protocol, CommandType.RESPONSE, 1, Command.GET_PEDESTALS, states
+                ),
+                number=number,
+            )
+            / number
+        )
+        results[f"decode_get_pedestals_{name}"] = (
+            timeit.timeit(lambda: PacketDecoder().feed(packet), number=number) / number
+        )
+    line = encode_packet(
+        Protocol.ASCII, CommandType.RESPONSE, 1, Command.GET_PEDESTALS, states
+    ).decode("utf-8")
+    results["parse_command"] = (
+        timeit.timeit(lambda: parse_command(line), number=number) / number
+    )
+    results["parse_pedestal_states"] = (
+        timeit.timeit(lambda: parse_pedestal_states(states, "1"), number=number) / number
+    )
+    return results
+
+
+async def run(args):
+    main.SIMULATE = True
+    main.HUBS = {str(i + 1): None for i in range(args.hubs)}
+    main.SIMULATOR_OPTIONS = {
+        "num_pedestals": args.pedestals,
+        "latency": args.latency,
+        "mtu": args.mtu,
+        "loss": args.loss,
+        "seed": 0,
+    }
+    server = ServerThread(args.port)
+    server.start()
+    # Let the simulated hub connect and report its pedestals
+    await asyncio.sleep(args.warmup)
+
+    scenarios = []
+    for num_clients in args.clients:
+        print(f"running {num_clients} clients for {args.duration} seconds")
+        scenarios.append(
+            await run_scenario(server, num_clients, args.duration, args.think_time)
+        )
+    return scenarios
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--think-time", type=float, default=0.1)
+    parser.add_argument("--warmup", type=float, default=3)
+    parser.add_argument("--hubs", type=int, default=1)
+    parser.add_argument("--pedestals", type=int, default=16)
+    parser.add_argument("--latency", type=float, default=0.01)
+    parser.add_argument("--mtu", type=int, default=20)
+    parser.add_argument("--loss", type=float, default=0.0)
+    parser.add_argument("--port", type=int, default=5001)
+    parser.add_argument("--microbenchmark-number", type=int, default=10000)
+    parser.add_argument("--output", default="benchmark_results.json")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "options": vars(args),
+        "microbenchmarks": run_microbenchmarks(args.microbenchmark_number),
+        "scenarios": asyncio.run(run(args)),
+    }
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results, indent=2))
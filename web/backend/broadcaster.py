@@ -0,0 +1,175 @@
+import asyncio
+import json
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+except ImportError:
+    dumps = json.dumps
+
+
+class Subscription:
+    """
+    A single client's view of the broadcaster.
+
+    Pending changes are coalesced into at most one queued wakeup, so a slow client only
+    ever receives the latest state rather than every stale snapshot in between.
+    """
+
+    def __init__(self, broadcaster, delta=False):
+        self.broadcaster = broadcaster
+        self.delta = delta
+        # The last state version sent to the client, or None if the client needs a snapshot
+        self.version = None
+        self.queue = asyncio.Queue(1)
+
+    def notify(self):
+        """Signals that a new state version is available."""
+        if not self.queue.full():
+            self.queue.put_nowait(None)
+
+    def resync(self):
+        """Forces a full snapshot to be sent on the next update."""
+        self.version = None
+        self.notify()
+
+    async def get(self):
+        """Waits for and returns the next serialized message for the client."""
+        while True:
+            await self.queue.get()
+            message = self.broadcaster.message_for(self)
+            if message is not None:
+                return message
+
+
+class Broadcaster:
+    """
+    Publishes state to all subscribed clients.
+
+    Every change increments the state version. Clients in the default mode receive the
+    full snapshot on every change. Clients in delta mode receive one full snapshot, then
+    only per-address differences; a delta applies to the state one version prior, so clients
+    seeing a version gap should request a resync.
+
+    Each snapshot, delta, and reply is serialized once per version, regardless of the number of
+    subscribers. Serialization uses orjson if it is installed.
+    """
+
+    def __init__(self, method, delta_method):
+        self.method = method
+        self.delta_method = delta_method
+        self.version = 0
+        self.state = None
+        # Whether the state is last known state that hasn't been confirmed yet
+        self.stale = False
+        self.message = None
+        self.delta_message = None
+        # Serialized replies containing the current state, by method
+        self.replies = {}
+        self.subscriptions = set()
+
+    def subscribe(self, delta=False):
+        """Returns a new subscription, primed with the current snapshot if there is one."""
+        subscription = Subscription(self, delta=delta)
+        if self.message is not None:
+            subscription.notify()
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, state, stale=False):
+        """
+        Publishes the state to all subscriptions, returning False if the state is unchanged.
+
+        Args:
+            state: The new state
+            stale (bool): Whether the state is last known state that hasn't been confirmed yet
+        """
+        if self.message is not None and state == self.state and stale == self.stale:
+            return False
+        delta = diff_pedestals(self.state, state) if self.state is not None else None
+        self.state = state
+        self.stale = stale
+        self.version += 1
+        self.message = dumps(
+            {
+                "method": self.method,
+                "version": self.version,
+                "stale": stale,
+                "data": state,
+            }
+        )
+        self.replies = {}
+        self.delta_message = (
+            dumps(
+                {
+                    "method": self.delta_method,
+                    "version": self.version,
+                    "stale": stale,
+                    "data": delta,
+                }
+            )
+            if delta is not None
+            else None
+        )
+        for subscription in self.subscriptions:
+            subscription.notify()
+        return True
+
+    def reply(self, method):
+        """Returns the serialized reply to a method with the current state as its data."""
+        reply = self.replies.get(method)
+        if reply is None:
+            reply = dumps({"method": method, "stale": self.stale, "data": self.state})
+            self.replies[method] = reply
+        return reply
+
+    def message_for(self, subscription):
+        """Returns the message bringing the subscription up to date, or None if it already is."""
+        if subscription.version == self.version or self.message is None:
+            return None
+        if (
+            subscription.delta
+            and subscription.version == self.version - 1
+            and self.delta_message is not None
+        ):
+            message = self.delta_message
+        else:
+            message = self.message
+        subscription.version = self.version
+        return message
+
+
+def diff_pedestals(old, new):
+    """
+    Returns the per-address differences between two pedestal lists:
+        - added: Pedestals whose address is only in the new list
+        - removed: Addresses only in the old list
+        - changed: The address and changed fields of pedestals in both lists
+    """
+    old_by_address = {pedestal["address"]: pedestal for pedestal in old}
+    new_addresses = set()
+    added = []
+    changed = []
+    for pedestal in new:
+        address = pedestal["address"]
+        new_addresses.add(address)
+        old_pedestal = old_by_address.get(address)
+        if old_pedestal is None:
+            added.append(pedestal)
+            continue
+        change = {
+            key: value
+            for key, value in pedestal.items()
+            if old_pedestal.get(key) != value
+        }
+        if change:
+            change["address"] = address
+            changed.append(change)
+    removed = [address for address in old_by_address if address not in new_addresses]
+    return {"added": added, "removed": removed, "changed": changed}
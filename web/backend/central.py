@@ -1,163 +1,312 @@
 import asyncio
-import contextlib
+import random
+import time
 import adafruit_logging as logging
-from adafruit_ble import BLERadio
-from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
-from adafruit_ble.services.nordic import UARTService
 
+import metrics
 from log import MyHandler
-from command import CommandType, Command, int_to_ascii_byte, parse_command
+from command import (
+    CommandType,
+    Command,
+    Protocol,
+    PacketDecoder,
+    SUPPORTED_PROTOCOLS,
+    encode_packet,
+)
+from multiplexer import CommandMultiplexer, Priority
 
-from concurrent.futures import ThreadPoolExecutor
+# Seconds without receiving any packet before probing the hub with a healthcheck
+HEALTHCHECK_QUIET_PERIOD = 2
+# Seconds between healthcheck probes while the link stays quiet
+HEALTHCHECK_PROBE_INTERVAL = 1
+# Seconds without receiving any packet before the link is considered dead
+LIVENESS_DEADLINE = 4
+
+# Seconds before the first reconnect retry, doubling on each failed attempt up to the maximum
+RECONNECT_BACKOFF_INITIAL = 0.1
+RECONNECT_BACKOFF_MAX = 10
+# Seconds a request is held waiting for the link to come back before it is dropped
+RECONNECT_HOLD_TIMEOUT = 5
+
+# Command names by value, for labelling metrics
+COMMAND_NAMES = {
+    value: name.lower() for name, value in vars(Command).items() if name.isupper()
+}
+
+# Priority names by value, for labelling metrics
+PRIORITY_NAMES = {
+    value: name.lower() for name, value in vars(Priority).items() if name.isupper()
+}
+
+COMMAND_RTT = metrics.Histogram(
+    "pedestals_command_rtt_seconds",
+    "Round trip time of command requests to the hub, including time waiting to be sent",
+)
+COMMAND_TIMEOUTS = metrics.Counter(
+    "pedestals_command_timeouts_total", "Command requests that saw no response in time"
+)
+RECONNECTS = metrics.Counter(
+    "pedestals_ble_reconnects_total", "Times the link to the hub was reset"
+)
+CONNECT_DURATION = metrics.Histogram(
+    "pedestals_ble_connect_seconds",
+    "Time spent scanning for and connecting to the hub",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10),
+)
+PENDING_COMMANDS = metrics.Gauge(
+    "pedestals_pending_commands", "Command requests awaiting a response"
+)
+HEALTHCHECK_FAILURES = metrics.Counter(
+    "pedestals_healthcheck_failures_total",
+    "Times the hub was silent past the liveness deadline",
+)
 
 
 class BLEClient:
-    def __init__(self):
-        self.executor = ThreadPoolExecutor(1)
+    def __init__(self, transport=None, hub_id=None):
+        """
+        Args:
+            transport: Carries bytes to and from the hub, defaulting to BLE. See BLETransport.
+            hub_id (str): Identifies the hub in metrics when connecting to several hubs
+        """
+        if transport is None:
+            from transport import BLETransport
+
+            transport = BLETransport()
+        self.transport = transport
+        self.decoder = PacketDecoder()
+        # Packets are sent as ASCII until a newer protocol is negotiated with the hub
+        self.protocol = Protocol.ASCII
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)  # type: ignore
-        self.logger.addHandler(MyHandler(self.__class__.__name__))
-        self.ble = BLERadio()
-        self.uart = None
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
         self.healthcheck_task = None
-        self.healthcheck_num_failed = 0
-        self.pending_commands = {}
-        self.packet_id = 0
+        # When a packet was last received, any packet showing the hub is alive
+        self.last_received = time.monotonic()
+        # Tracks in-flight requests so the background poll, healthchecks, and user commands
+        # can share the link, sending user commands first
+        self.multiplexer = CommandMultiplexer(window=4, timeout=5)
+        self.metric_labels = {"hub": hub_id} if hub_id is not None else {}
+        PENDING_COMMANDS.set_function(
+            lambda: len(self.multiplexer.pending), **self.metric_labels
+        )
+        # Set once the link is up and the protocol negotiated, requests are held until then
+        self.ready = asyncio.Event()
+        self.connecting = False
+        # Called with the command and data of state change notifications pushed by the hub
+        self.notification_handler = None
+        # Awaited each time the link is ready, e.g. to restore state lost if the hub restarted
+        self.connected_handler = None
 
     async def connect(self):
-        if not self.ble.connected:
-            self.logger.info("starting scanning")
+        """Connects to the hub, retrying with jittered exponential backoff until it succeeds."""
+        if self.connecting or self.transport.connected:
+            return
+        self.connecting = True
+        try:
+            backoff = RECONNECT_BACKOFF_INITIAL
+            while True:
+                start = time.monotonic()
+                await self.transport.connect()
+                CONNECT_DURATION.observe(time.monotonic() - start, **self.metric_labels)
+                if self.transport.connected:
+                    break
+                delay = random.uniform(backoff / 2, backoff)
+                self.logger.info(f"connecting failed, retrying in {delay:.2f} seconds")
+                await asyncio.sleep(delay)
+                backoff = min(backoff * 2, RECONNECT_BACKOFF_MAX)
+        finally:
+            self.connecting = False
+        self.last_received = time.monotonic()
+        asyncio.create_task(self._read())
+        await self._negotiate_protocol()
+        self.healthcheck_task = asyncio.create_task(self._healthcheck())
+        self.ready.set()
+        if self.connected_handler is not None:
+            asyncio.create_task(self.connected_handler())
 
-            def scan():
-                try:
-                    for advertisement in self.ble.start_scan(
-                        ProvideServicesAdvertisement, timeout=5
-                    ):
-                        if (
-                            advertisement is not None
-                            and UARTService not in advertisement.services  # type: ignore
-                        ):
-                            continue
-                        self.logger.info("found UART service, connecting")
-                        connection = self.ble.connect(advertisement)
-                        self.uart = connection[UARTService]
-                        self.logger.info("connected")
-                        break
-                except Exception as e:
-                    self.logger.error(f"BLE scanning failed: {e}")
-
-            # Allow the coroutine to yield by scanning in a new thread
-            await asyncio.get_running_loop().run_in_executor(self.executor, scan)
+    async def _negotiate_protocol(self):
+        """Switches to the most preferred protocol supported by the hub, falling back to ASCII."""
+        response = await self._request(
+            Command.NEGOTIATE_PROTOCOL,
+            SUPPORTED_PROTOCOLS,
+            timeout=1,
+            priority=Priority.LIVENESS,
+        )
+        if response is not None and len(response[1]) > 0:
+            self.protocol = response[1][0]
+        self.logger.info(f"using protocol version {self.protocol}")
 
-            self.ble.stop_scan()
-            asyncio.create_task(self._read())
-            self.healthcheck_task = asyncio.create_task(self._healthcheck())
-
-    def write(self, data):
-        self.logger.debug("TX: %s", data)
-        if self.ble.connected and self.uart is not None:
-            self.uart.write((data + "\n").encode("utf-8"))
+    def write(self, packet):
+        self.logger.debug("TX: %s", packet)
+        self.transport.write(packet)
 
     async def _reset(self):
-        for conn in self.ble.connections:
-            if conn is not None:
-                conn.disconnect()
-        self.pending_commands = {}
+        RECONNECTS.inc(**self.metric_labels)
+        self.ready.clear()
+        self.transport.disconnect()
+        self.multiplexer.fail_all("disconnected")
+        self.decoder = PacketDecoder()
+        self.protocol = Protocol.ASCII
         if self.healthcheck_task is not None:
             self.healthcheck_task.cancel()
-        self.healthcheck_num_failed = 0
         asyncio.create_task(self.connect())
 
     async def _read(self):
-        while self.ble.connected:
-            l = await asyncio.create_task(self._read_line())
-            if l:
-                self.logger.debug("RX: %s", l)
-                command_type, id, command, data = parse_command(l)
-                if command_type == CommandType.RESPONSE:
-                    callback, event = self.pending_commands.get(id, None)
-                    if callback:
-                        callback(command, data)
-                        event.set()
-                    else:
-                        self.logger.error(
-                            "no callback for id: "
-                            + id
-                            + " "
-                            + str(self.pending_commands)
-                        )
-                else:
-                    if command == Command.HEALTHCHECK:
-                        await self.send_command_response(id, command)
+        while self.transport.connected:
+            chunk = await self.transport.read()
+            packets = self.decoder.feed(chunk)
+            if packets:
+                self.last_received = time.monotonic()
+            for packet in packets:
+                self.logger.debug("RX: %s", packet)
+                try:
+                    await self._dispatch(*packet)
+                except Exception as e:
+                    self.logger.error(f"failed to handle packet {packet}: {e}")
 
         self.logger.info("not connected, reconnecting")
         asyncio.create_task(self._reset())
 
-    async def _read_line(self):
-        if self.uart is not None and self.uart.in_waiting > 0:
-            l = self.uart.readline()
-            if l != b"":
-                l = l.decode("utf-8").strip("\n")
-                return l
-        return None
-
-    async def send_command_request(self, command, *data, response_handler=None):
-        if self.ble.connected:
-            packet_id = int_to_ascii_byte(self.packet_id)
-            id = "{}{}".format(CommandType.REQUEST, packet_id)
-            packet = "{}|{}|{}".format(id, int_to_ascii_byte(command), "#".join(data))
-            event = asyncio.Event()
-            self.pending_commands[packet_id] = (response_handler, event)
-            self.packet_id = self.packet_id + 1
-            self.write(packet)
-            if not await event_wait(event, 5):
-                self.logger.error(
-                    f"command {command} with ID {id} did not see a response after 5 seconds"
+    async def _dispatch(self, command_type, id, command, data):
+        """Handles a single decoded packet."""
+        if command_type == CommandType.RESPONSE:
+            if not self.multiplexer.resolve(id, command, data):
+                self.logger.warning(
+                    f"no pending request for id {id}, it may have timed out"
                 )
+        else:
+            if command == Command.HEALTHCHECK:
+                await self.send_command_response(id, command)
+            if command == Command.PEDESTALS_CHANGED:
+                await self.send_command_response(id, command)
+                if self.notification_handler is not None:
+                    self.notification_handler(command, data)
 
-    async def send_command_response(self, id, command, *data):
-        if self.ble.connected:
-            packet = "{}|{}|{}".format(
-                CommandType.RESPONSE + id, int_to_ascii_byte(command), "#".join(data)
-            )
-            self.write(packet)
+    async def send_command_request(
+        self,
+        command,
+        *data,
+        response_handler=None,
+        timeout=None,
+        priority=Priority.INTERACTIVE,
+    ):
+        """
+        Sends a command request and waits for the response.
 
-    def on_healthcheck_response(self, command, data):
-        self.healthcheck_num_failed = 0
+        Requests are sent in priority order when the link is busy, see CommandMultiplexer.
 
-    async def _healthcheck(self):
-        # Let the connection settle for a few seconds
-        await asyncio.sleep(3)
+        Requests made while reconnecting, or lost to a disconnect while in flight, are held and
+        replayed once the link is back, unless that takes longer than the hold timeout.
 
+        Returns a tuple of the response command and data, or None if the request failed.
+        """
         while True:
-            # Pessimistically set failed to have healthcheck responder reset to 0 on success
-            self.healthcheck_num_failed += 1
+            if not self.ready.is_set():
+                try:
+                    await asyncio.wait_for(self.ready.wait(), RECONNECT_HOLD_TIMEOUT)
+                except asyncio.TimeoutError:
+                    self.logger.error(f"command {command} dropped, hub not connected")
+                    return None
             try:
-                await asyncio.create_task(
-                    self.send_command_request(
-                        Command.HEALTHCHECK,
-                        response_handler=self.on_healthcheck_response,
-                    )
+                return await self._request(
+                    command,
+                    data,
+                    response_handler=response_handler,
+                    timeout=timeout,
+                    priority=priority,
+                    raise_disconnected=True,
                 )
-            except Exception as e:
-                self.logger.error(f"sending healthcheck failed: {e}")
-            if self.healthcheck_num_failed > 2:
-                self.logger.error("failed healthcheck, disconnecting")
-                if self.ble.connections and len(self.ble.connections) > 0:
-                    self.ble.connections[0].disconnect()  # type: ignore
-                return
-            await asyncio.sleep(1)
+            except ConnectionError:
+                self.logger.info(f"command {command} interrupted, replaying")
+                if not self.transport.connected:
+                    # The reader resets the link once it notices, hold until it is back
+                    self.ready.clear()
 
+    async def _request(
+        self,
+        command,
+        data,
+        response_handler=None,
+        timeout=None,
+        priority=Priority.INTERACTIVE,
+        raise_disconnected=False,
+    ):
+        """Sends a request on the current link, returning None if it fails."""
+        if not self.transport.connected:
+            if raise_disconnected:
+                raise ConnectionError("disconnected")
+            return None
 
-async def event_wait(event, timeout):
-    """
-    Waits on an asyncio.Event() until the timeout.
+        def write(packet_id):
+            self.write(
+                encode_packet(
+                    self.protocol, CommandType.REQUEST, packet_id, command, data
+                )
+            )
+
+        name = COMMAND_NAMES.get(command, str(command))
+        start = time.monotonic()
+        try:
+            response = await self.multiplexer.request(
+                write,
+                response_handler=response_handler,
+                timeout=timeout,
+                priority=priority,
+            )
+            COMMAND_RTT.observe(
+                time.monotonic() - start,
+                command=name,
+                priority=PRIORITY_NAMES[priority],
+                **self.metric_labels,
+            )
+            return response
+        except asyncio.TimeoutError:
+            COMMAND_TIMEOUTS.inc(command=name, **self.metric_labels)
+            self.logger.error(f"command {command} did not see a response in time")
+        except ConnectionError as e:
+            if raise_disconnected:
+                raise
+            self.logger.error(f"command {command} failed: {e}")
+        return None
 
-    Returns True when the event is set, returns False if the timeout elapses.
+    async def send_command_response(self, id, command, *data):
+        if self.transport.connected:
+            self.write(
+                encode_packet(self.protocol, CommandType.RESPONSE, id, command, data)
+            )
 
-        See: https://stackoverflow.com/a/49632779
-    """
-    # suppress TimeoutError because we'll return False in case of timeout
-    with contextlib.suppress(asyncio.TimeoutError):
-        await asyncio.wait_for(event.wait(), timeout)
-    return event.is_set()
+    async def _healthcheck(self):
+        """
+        Tracks liveness from received packets, probing the hub only when the link is quiet.
+
+        Regular traffic such as the pedestal state poll keeps the link alive without extra
+        packets. Once nothing has been received for the quiet period a healthcheck is sent every
+        probe interval, and if nothing arrives by the liveness deadline the link is dropped.
+        """
+        while True:
+            quiet = time.monotonic() - self.last_received
+            if quiet >= LIVENESS_DEADLINE:
+                HEALTHCHECK_FAILURES.inc(**self.metric_labels)
+                self.logger.error(
+                    f"nothing received for {quiet:.1f} seconds, disconnecting"
+                )
+                self.transport.disconnect()
+                return
+            if quiet >= HEALTHCHECK_QUIET_PERIOD:
+                # Any response, or other packet, moves the deadline, so don't wait on the probe
+                asyncio.create_task(
+                    self._request(
+                        Command.HEALTHCHECK,
+                        (),
+                        timeout=LIVENESS_DEADLINE - quiet,
+                        priority=Priority.LIVENESS,
+                    )
+                )
+                await asyncio.sleep(
+                    min(HEALTHCHECK_PROBE_INTERVAL, LIVENESS_DEADLINE - quiet)
+                )
+            else:
+                await asyncio.sleep(HEALTHCHECK_QUIET_PERIOD - quiet)
@@ -1,15 +1,53 @@
 import os
+import re
 import asyncio
+import signal
 import adafruit_logging as logging
 from aiohttp import web
 
+import metrics
 from log import MyHandler
-from pedestal_cache import PedestalCache
+from pedestal_cache import (
+    MAX_EFFECT_KEYFRAMES,
+    PEDESTAL_I2C_ADDRESSES,
+    PedestalCache,
+)
+from state_store import StateStore
+from static_assets import StaticAssets
 
 routes = web.RouteTableDef()
 
-# Set to True to mock the BLE interface for development purposes
-MOCK = False
+# Set to True to run against an in-process simulated hub for development purposes
+SIMULATE = False
+
+# The hubs to connect to, by hub ID, with the BLE name each hub advertises (HUB_NAME in the
+# hub's code.py). A name of None connects to any hub, which only works with a single hub.
+HUBS = {"1": None}
+
+# Options for each simulated hub, see simulator.SimulatedHub
+SIMULATOR_OPTIONS = {"num_pedestals": 3}
+
+# The SQLite database the last known pedestal state is saved to, not used when simulating
+STATE_STORE_PATH = "pedestals.db"
+
+# Websocket API colors, as 6 hex digits, and pedestal addresses, as the hub ID and I2C address
+HEX_COLOR = re.compile(r"^[0-9a-fA-F]{6}$")
+PEDESTAL_ADDRESS = re.compile(r"^[^:]+:[0-9a-fA-F]{2}$")
+
+# The per-pedestal methods, by whether their data carries colors or only addresses
+PEDESTAL_METHOD_COLORS = {
+    "setPedestalsColor": True,
+    "blinkPedestals": False,
+    "stopPedestalsBlinking": False,
+}
+
+# The data fields checked for each group method, besides the group name
+GROUP_METHOD_FIELDS = {
+    "defineGroup": ("addresses",),
+    "setGroupColor": ("color",),
+    "setGroupBlinking": ("blinking",),
+}
+
 
 def absolute_path_relative_to_module_file(path):
     return os.path.join(os.path.dirname(os.path.realpath(__file__)), path)
@@ -19,11 +57,87 @@ async def healthcheck(request):
     return web.Response(text="I'm up!")
 
 
-@routes.get("/")
-async def index(request):
-    """Serves the built React app."""
-    with open(absolute_path_relative_to_module_file("../build/index.html")) as f:
-        return web.Response(text=f.read(), content_type="text/html")
+@routes.get("/metrics")
+async def metrics_handler(request):
+    """Serves metrics in the Prometheus text exposition format."""
+    return web.Response(
+        body=metrics.REGISTRY.render().encode("utf-8"),
+        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+def pedestals_data_error(method_data, colors):
+    """Returns why the data of a per-pedestal method is invalid, or None if it is valid."""
+    if not isinstance(method_data, list):
+        return "data must be a list"
+    for entry in method_data:
+        address = entry.get("address") if colors and isinstance(entry, dict) else entry
+        if not (isinstance(address, str) and PEDESTAL_ADDRESS.match(address)):
+            return "address must be a pedestal address"
+        color = entry.get("color") if colors else None
+        if colors and not (isinstance(color, str) and HEX_COLOR.match(color)):
+            return "color must be 6 hex digits"
+    return None
+
+
+def group_data_error(method_data, *fields):
+    """Returns why the data of a group method is invalid, or None if it is valid."""
+    if not isinstance(method_data, dict):
+        return "data must be an object"
+    name = method_data.get("name")
+    if not isinstance(name, str) or not name:
+        return "name must be a non-empty string"
+    addresses = method_data.get("addresses", [])
+    if "addresses" in fields and (
+        not isinstance(addresses, list)
+        or not all(
+            isinstance(address, str) and PEDESTAL_ADDRESS.match(address)
+            for address in addresses
+        )
+    ):
+        return "addresses must be a list of pedestal addresses"
+    color = method_data.get("color")
+    if "color" in fields and not (isinstance(color, str) and HEX_COLOR.match(color)):
+        return "color must be 6 hex digits"
+    if "blinking" in fields and not isinstance(method_data.get("blinking"), bool):
+        return "blinking must be true or false"
+    return None
+
+
+def effect_data_error(effect):
+    """Returns why the data of an effect request is invalid, or None if it is valid."""
+    if not isinstance(effect, dict):
+        return "data must be an object"
+    addresses = effect.get("addresses", [])
+    if not isinstance(addresses, list) or not all(
+        isinstance(address, str)
+        and PEDESTAL_ADDRESS.match(address)
+        and int(address.split(":")[1], 16) in PEDESTAL_I2C_ADDRESSES
+        for address in addresses
+    ):
+        return "addresses must be a list of pedestal addresses"
+    keyframes = effect.get("keyframes", [])
+    if not isinstance(keyframes, list):
+        return "keyframes must be a list"
+    if len(keyframes) > MAX_EFFECT_KEYFRAMES:
+        return f"an effect has at most {MAX_EFFECT_KEYFRAMES} keyframes"
+    for keyframe in keyframes:
+        if not isinstance(keyframe, dict):
+            return "keyframes must be objects"
+        position = keyframe.get("position")
+        if (
+            isinstance(position, bool)
+            or not isinstance(position, (int, float))
+            or not 0 <= position <= 1
+        ):
+            return "keyframe position must be a number from 0 to 1"
+        color = keyframe.get("color")
+        if not (isinstance(color, str) and HEX_COLOR.match(color)):
+            return "keyframe color must be 6 hex digits"
+    duration = effect.get("duration", 1000)
+    if isinstance(duration, bool) or not isinstance(duration, (int, float)):
+        return "duration must be a number of milliseconds"
+    return None
 
 
 @routes.get("/websocket")
@@ -34,40 +148,91 @@ async def websocket_handler(request):
     socket = web.WebSocketResponse()
     await socket.prepare(request)
 
-    # Update the client with the current state every second, in order to receive updates
-    # made by other clients
+    # Forward pedestal state to the client whenever it changes, in order to receive updates
+    # made by other clients. Clients connecting with `?mode=delta` receive a versioned snapshot
+    # followed by per-address deltas.
+    subscription = pedestal_cache.subscribe(
+        delta=request.query.get("mode") == "delta"
+    )
+
     async def send_pedestal_updates(socket):
         while True:
-            pedestals = await pedestal_cache.get_pedestals()
-            await socket.send_json({"method": "getPedestals", "data": pedestals})
-            await asyncio.sleep(1)
+            message = await subscription.get()
+            await socket.send_str(message)
 
     update_task = asyncio.create_task(send_pedestal_updates(socket))
 
-    # Handle any messages from the client
-    async for message in socket:
-        data = message.json()
-        logger.debug("ws RX: %s", data)
-        method = data.get("method")
-        if method:
-            if method == "healthcheck":
-                await socket.send_json({"method": method, "data": {}})
-            if method == "setPedestalsColor":
-                method_data = data.get("data", [])
-                new_pedestals = await pedestal_cache.set_pedestals_color(method_data)
-                await socket.send_json({"method": method, "data": new_pedestals})
-            if method == "blinkPedestals":
-                method_data = data.get("data", [])
-                new_pedestals = await pedestal_cache.blink_pedestals(method_data)
-                await socket.send_json({"method": method, "data": new_pedestals})
-            if method == "stopPedestalsBlinking":
-                method_data = data.get("data", [])
-                new_pedestals = await pedestal_cache.stop_pedestals_blinking(
-                    method_data
-                )
-                await socket.send_json({"method": method, "data": new_pedestals})
-    # Clean up the updating task
-    update_task.cancel()
+    try:
+        # Handle any messages from the client
+        async for message in socket:
+            data = message.json()
+            logger.debug("ws RX: %s", data)
+            method = data.get("method")
+            if method:
+                if method == "healthcheck":
+                    await socket.send_json({"method": method, "data": {}})
+                if method == "resync":
+                    subscription.resync()
+                # Writes matching the known pedestal state are skipped, unless forced
+                force = bool(data.get("force", False))
+                # Invalid writes are rejected here, as they are coalesced with other clients'
+                if method in PEDESTAL_METHOD_COLORS:
+                    method_data = data.get("data", [])
+                    error = pedestals_data_error(
+                        method_data, PEDESTAL_METHOD_COLORS[method]
+                    )
+                    if error is not None:
+                        await socket.send_json({"method": method, "error": error})
+                        continue
+                # Replies carry the current pedestal state, serialized once for all clients
+                if method == "setPedestalsColor":
+                    await pedestal_cache.set_pedestals_color(method_data, force=force)
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+                if method == "blinkPedestals":
+                    await pedestal_cache.blink_pedestals(method_data, force=force)
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+                if method == "stopPedestalsBlinking":
+                    await pedestal_cache.stop_pedestals_blinking(
+                        method_data, force=force
+                    )
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+                if method == "setPedestalsEffect":
+                    method_data = data.get("data", {})
+                    error = effect_data_error(method_data)
+                    if error is not None:
+                        await socket.send_json({"method": method, "error": error})
+                        continue
+                    await pedestal_cache.set_pedestals_effect(method_data)
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+                if method == "getGroups":
+                    await socket.send_json(
+                        {"method": method, "data": pedestal_cache.get_groups()}
+                    )
+                if method in GROUP_METHOD_FIELDS:
+                    method_data = data.get("data", {})
+                    error = group_data_error(method_data, *GROUP_METHOD_FIELDS[method])
+                    if error is not None:
+                        await socket.send_json({"method": method, "error": error})
+                        continue
+                if method == "defineGroup":
+                    await pedestal_cache.define_group(
+                        method_data["name"], method_data.get("addresses", [])
+                    )
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+                if method == "setGroupColor":
+                    await pedestal_cache.set_group_color(
+                        method_data["name"], method_data["color"], force=force
+                    )
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+                if method == "setGroupBlinking":
+                    await pedestal_cache.set_group_blinking(
+                        method_data["name"], method_data["blinking"], force=force
+                    )
+                    await socket.send_str(pedestal_cache.broadcaster.reply(method))
+    finally:
+        # Clean up the updating task, even if handling a message failed
+        update_task.cancel()
+        pedestal_cache.unsubscribe(subscription)
 
     return socket
 
@@ -78,15 +243,44 @@ async def setup_teardown(app):
     logger.setLevel(logging.INFO)  # type: ignore
     logger.addHandler(MyHandler(app.__class__.__name__))
     app["logger"] = logger
-    app["pedestal_cache"] = PedestalCache(mock=MOCK)
+    hubs = {}
+    state_store = None
+    if SIMULATE:
+        from simulator import SimulatedHub
+
+        for hub_id in HUBS:
+            hubs[hub_id] = SimulatedHub(**SIMULATOR_OPTIONS).start().central_transport()
+    else:
+        from transport import BLETransport
+
+        for hub_id, name in HUBS.items():
+            hubs[hub_id] = BLETransport(name=name)
+        state_store = StateStore(absolute_path_relative_to_module_file(STATE_STORE_PATH))
+    app["pedestal_cache"] = PedestalCache(hubs=hubs, state_store=state_store)
+    # Send SIGHUP to pick up a new build of the React app without restarting
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(
+            signal.SIGHUP, lambda: asyncio.create_task(app["static_assets"].reload())
+        )
+    except (AttributeError, NotImplementedError, RuntimeError):
+        # Signals are only available on Unix, in the main thread
+        logger.info("not reloading static assets on SIGHUP")
+    lag_task = asyncio.create_task(metrics.monitor_event_loop_lag())
     yield
+    lag_task.cancel()
+    if state_store is not None:
+        state_store.close()
+    if hasattr(signal, "SIGHUP"):
+        loop.remove_signal_handler(signal.SIGHUP)
 
 
 def main():
     app = web.Application()
-    # Serve from the React app build folder
-    routes.static("/", absolute_path_relative_to_module_file("../build"))
     app.add_routes(routes)
+    # Serve the React app build folder from memory, after the API routes
+    app["static_assets"] = StaticAssets(absolute_path_relative_to_module_file("../build"))
+    app.router.add_get("/{path:.*}", app["static_assets"].handle)
     app.cleanup_ctx.append(setup_teardown)
     return app
 
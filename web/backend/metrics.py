@@ -0,0 +1,151 @@
+"""
+Minimal metrics in the Prometheus text exposition format.
+
+Metrics are registered with the module level registry when created, and rendered by the
+/metrics route.
+"""
+import asyncio
+import math
+import time
+
+# Default histogram buckets in seconds, from 1 ms to 10 s
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Seconds between samples of the event loop lag
+EVENT_LOOP_LAG_INTERVAL = 0.5
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def _value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.values = {}
+        registry.register(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        return [
+            f"{self.name}{_labels(labels)} {_value(value)}"
+            for labels, value in self.values.items()
+        ]
+
+
+class Gauge:
+    """A value that can go up and down, either set directly or read from a function on render."""
+
+    type = "gauge"
+
+    def __init__(self, name, help, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.functions = {}
+        registry.register(self)
+
+    def set(self, value, **labels):
+        self.values[tuple(sorted(labels.items()))] = value
+
+    def set_function(self, function, **labels):
+        self.functions[tuple(sorted(labels.items()))] = function
+
+    def samples(self):
+        values = dict(self.values)
+        for labels, function in self.functions.items():
+            values[labels] = function()
+        return [
+            f"{self.name}{_labels(labels)} {_value(value)}"
+            for labels, value in values.items()
+        ]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name, help, buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets) + (math.inf,)
+        # Per label set, a list of per-bucket counts, the sum, and the count
+        self.values = {}
+        registry.register(self)
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        bucket_counts, total, count = self.values.get(
+            key, ([0] * len(self.buckets), 0, 0)
+        )
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                bucket_counts[i] += 1
+                break
+        self.values[key] = (bucket_counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        for labels, (bucket_counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = labels + (("le", _value(bound)),)
+                samples.append(f"{self.name}_bucket{_labels(bucket_labels)} {cumulative}")
+            samples.append(f"{self.name}_sum{_labels(labels)} {_value(total)}")
+            samples.append(f"{self.name}_count{_labels(labels)} {count}")
+        return samples
+
+
+PROCESS_CPU = Gauge(
+    "pedestals_process_cpu_seconds", "CPU time used by the backend process"
+)
+PROCESS_CPU.set_function(time.process_time)
+
+EVENT_LOOP_LAG = Histogram(
+    "pedestals_event_loop_lag_seconds",
+    "Delay in waking a task beyond its scheduled time",
+)
+
+
+async def monitor_event_loop_lag():
+    """Samples the event loop lag until cancelled."""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(EVENT_LOOP_LAG_INTERVAL)
+        EVENT_LOOP_LAG.observe(max(0, loop.time() - start - EVENT_LOOP_LAG_INTERVAL))
@@ -0,0 +1,165 @@
+import asyncio
+import itertools
+
+# Seconds a request can be passed over by higher priority requests before it is sent anyway
+MAX_DEFER = 2
+
+
+class Priority:
+    """Request priority classes, lower values are sent first."""
+
+    # Commands a user is waiting on, e.g. setting colors from the web app
+    INTERACTIVE = 0
+    # Commands keeping the link up, e.g. healthchecks and protocol negotiation
+    LIVENESS = 1
+    # Commands nobody is waiting on, e.g. the pedestal state poll
+    BACKGROUND = 2
+
+
+class CommandMultiplexer:
+    """
+    Multiplexes concurrent command requests over a single link.
+
+    Each request is assigned a packet ID not used by any other in-flight request, and
+    waits on its own future for the matching response. At most `window` requests are in
+    flight at once, further requests wait for a slot. Requests are removed from the
+    pending table as soon as they complete, time out, or are cancelled.
+
+    Waiting requests are given slots in priority order, first come first served within a
+    priority. Background requests are deferred while any interactive request is waiting or in
+    flight, so a poll doesn't get ahead of a user's command. Requests waiting longer than
+    `max_defer` seconds are served in arrival order alongside interactive ones, bounding
+    starvation.
+    """
+
+    def __init__(self, window=4, timeout=5, max_defer=MAX_DEFER):
+        # Packet IDs are a single byte, so more than 256 in-flight requests would collide
+        assert 0 < window <= 256
+        self.window = window
+        self.timeout = timeout
+        self.max_defer = max_defer
+        self.pending = {}
+        self.next_id = 0
+        self.in_flight = 0
+        # Requests waiting for a slot, as (priority, sequence, enqueue time, future) lists
+        self.waiting = []
+        self.sequence = itertools.count()
+        # Interactive requests waiting or in flight
+        self.interactive = 0
+        self.defer_timer = None
+
+    def _allocate_id(self):
+        """Returns the next packet ID not used by an in-flight request."""
+        while self.next_id in self.pending:
+            self.next_id = (self.next_id + 1) % 256
+        packet_id = self.next_id
+        self.next_id = (self.next_id + 1) % 256
+        return packet_id
+
+    async def request(
+        self, write, response_handler=None, timeout=None, priority=Priority.INTERACTIVE
+    ):
+        """
+        Sends a request and waits for its response.
+
+        Args:
+            write (Callable[[int], None]): Writes the request with the provided packet ID
+            response_handler (Callable[[int, List], None]): Called with the response command and data
+            timeout (float): Seconds to wait for a response, defaulting to the multiplexer timeout
+            priority (Priority): Orders the request against others waiting for a slot
+
+        Returns:
+            A tuple of the response command and data.
+
+        Raises:
+            asyncio.TimeoutError: If no response is received before the timeout
+            ConnectionError: If the link is reset while the request is in flight
+        """
+        if priority == Priority.INTERACTIVE:
+            self.interactive += 1
+        try:
+            await self._acquire(priority)
+            try:
+                packet_id = self._allocate_id()
+                future = asyncio.get_running_loop().create_future()
+                self.pending[packet_id] = (future, response_handler)
+                try:
+                    write(packet_id)
+                    return await asyncio.wait_for(
+                        future, timeout if timeout is not None else self.timeout
+                    )
+                finally:
+                    self.pending.pop(packet_id, None)
+            finally:
+                self.in_flight -= 1
+        finally:
+            if priority == Priority.INTERACTIVE:
+                self.interactive -= 1
+            self._admit()
+
+    async def _acquire(self, priority):
+        """Waits for a slot, taking it right away if one is free and nothing is waiting."""
+        loop = asyncio.get_running_loop()
+        waiter = [priority, next(self.sequence), loop.time(), loop.create_future()]
+        self.waiting.append(waiter)
+        self._admit()
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            if waiter in self.waiting:
+                self.waiting.remove(waiter)
+            elif not waiter[3].cancelled():
+                # The slot was given to the request as it was cancelled, pass it on
+                self.in_flight -= 1
+                self._admit()
+            raise
+
+    def _admit(self):
+        """Gives free slots to waiting requests, in priority order."""
+        if self.defer_timer is not None:
+            self.defer_timer.cancel()
+            self.defer_timer = None
+        now = asyncio.get_running_loop().time()
+        while self.in_flight < self.window and self.waiting:
+            cancelled = [w for w in self.waiting if w[3].done()]
+            for w in cancelled:
+                self.waiting.remove(w)
+            if not self.waiting:
+                return
+            # Requests waiting for too long are sent as if interactive, so none starve
+            waiter = min(
+                self.waiting,
+                key=lambda w: (
+                    Priority.INTERACTIVE if now - w[2] >= self.max_defer else w[0],
+                    w[1],
+                ),
+            )
+            deferred = now - waiter[2] < self.max_defer
+            if waiter[0] == Priority.BACKGROUND and self.interactive and deferred:
+                # Try again once the oldest background request has waited long enough
+                self.defer_timer = asyncio.get_running_loop().call_at(
+                    waiter[2] + self.max_defer, self._admit
+                )
+                return
+            self.waiting.remove(waiter)
+            self.in_flight += 1
+            waiter[3].set_result(None)
+
+    def resolve(self, packet_id, command, data):
+        """Completes the request with the packet ID, returning False if it is no longer pending."""
+        future, response_handler = self.pending.pop(packet_id, (None, None))
+        if future is None or future.done():
+            return False
+        try:
+            if response_handler:
+                response_handler(command, data)
+        finally:
+            future.set_result((command, data))
+        return True
+
+    def fail_all(self, reason):
+        """Fails all in-flight requests, e.g. when the link is lost."""
+        for future, _ in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError(reason))
+        self.pending = {}
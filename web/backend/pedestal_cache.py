@@ -1,113 +1,564 @@
 import asyncio
+import time
 import adafruit_logging as logging
 
+import metrics
 from log import MyHandler
-from central import BLEClient, event_wait
-from command import Command
+from broadcaster import Broadcaster
+from central import BLEClient
+from multiplexer import Priority
+from write_scheduler import WriteScheduler
+from command import (
+    Command,
+    Easing,
+    MAX_FRAME_PAYLOAD_LENGTH,
+    MAX_GROUPS,
+    hash_pedestal_states,
+)
+
+# The ID of the hub when only one is configured
+DEFAULT_HUB_ID = "1"
+
+# Seconds between polls of a hub's pedestal state after a write or a pedestal being attached
+# or detached, for the fast poll period
+POLL_INTERVAL_MIN = 0.5
+FAST_POLL_PERIOD = 2
+# The most seconds between polls, the interval doubling from the minimum while state is stable
+POLL_INTERVAL_MAX = 8
+# The most seconds between polls of hubs that push state changes, polls are then a safety net
+PUSH_POLL_INTERVAL_MAX = 30
+
+# Websocket effect easing names
+EASINGS = {
+    "linear": Easing.LINEAR,
+    "easeIn": Easing.EASE_IN,
+    "easeOut": Easing.EASE_OUT,
+    "easeInOut": Easing.EASE_IN_OUT,
+}
+
+# The longest effect duration in milliseconds that fits in the command
+MAX_EFFECT_DURATION = 0xFFFF
+
+# Pedestal I2C addresses, the range the hub scans for
+PEDESTAL_I2C_ADDRESSES = range(0x30, 0x40)
+
+# The most keyframes that fit in an effect command along with every pedestal on a hub, after
+# the duration, easing, loop, and address count bytes
+MAX_EFFECT_KEYFRAMES = (MAX_FRAME_PAYLOAD_LENGTH - 5 - len(PEDESTAL_I2C_ADDRESSES)) // 4
+
+WEBSOCKET_CLIENTS = metrics.Gauge(
+    "pedestals_websocket_clients", "Websocket clients subscribed to pedestal updates"
+)
+BROADCAST_QUEUE_DEPTH = metrics.Gauge(
+    "pedestals_broadcast_queue_depth",
+    "Subscribed clients with a pedestal update waiting to be sent",
+)
+
+
+class Hub:
+    """A hub's link, pending writes, and last reported pedestals."""
+
+    def __init__(self, hub_id, transport, write_tick, flush):
+        self.id = hub_id
+        self.ble_client = BLEClient(transport=transport, hub_id=hub_id)
+        # Batches rapid color and blinking changes into one command per tick
+        self.write_scheduler = WriteScheduler(
+            lambda colors, blinking: flush(self, colors, blinking), tick=write_tick
+        )
+        self.pedestals = []
+        # Whether the hub has reported its pedestals since startup
+        self.reported = False
+        # Whether the hub pushes state changes, see Command.PEDESTALS_CHANGED
+        self.pushes = False
+        # Set to poll the hub right away
+        self.wake = asyncio.Event()
+        # Until when, in monotonic seconds, to poll the hub at the minimum interval
+        self.fast_poll_until = 0
+        # Named groups of the hub's pedestals, as (group ID, member addresses) tuples by name
+        self.groups = {}
+        # The hash of the pedestal states last reported by the hub, sent with each poll so the
+        # hub only resends the states if they changed
+        self.state_hash = None
 
 
 class PedestalCache:
-    def __init__(self, mock=False):
-        self.mock = mock
-        self.mock_pedestals = [
-            {"address": "00", "color": "eb2e34", "blinking": True},
-            {"address": "01", "color": "a2bdf1", "blinking": False},
-            {"address": "02", "color": "00a12d", "blinking": False},
-        ]
+    """
+    Caches the state of the pedestals on one or more hubs.
+
+    Pedestal addresses are global, the hub ID and the pedestal's I2C address in hex, e.g. "1:30".
+    Each hub has its own link, poll loop, and write scheduler, so commands fan out to hubs
+    concurrently and a slow or disconnected hub doesn't hold up the others. The pedestals
+    reported by every hub are merged into one snapshot.
+
+    Hubs are polled only as often as there is demand for their state. Polling stops while no
+    websocket client is subscribed, speeds up briefly after writes and pedestals being attached
+    or detached, and backs off while the state is stable. Hubs that push state changes are
+    polled rarely.
+    """
+
+    def __init__(self, hubs=None, write_tick=0.05, state_store=None):
+        """
+        Args:
+            hubs (Dict[str, Any]): Transports carrying bytes to and from each hub, by hub ID. A
+                transport of None connects over BLE, see BLETransport. Defaults to a single BLE
+                hub with ID DEFAULT_HUB_ID.
+            write_tick (float): Seconds to coalesce color and blinking writes for
+            state_store (StateStore): Persists pedestal state, to show the last known state
+                while connecting to the hubs after a restart
+        """
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(logging.INFO)  # type: ignore
-        self.logger.addHandler(MyHandler(self.__class__.__name__))
-        self.ble_client = BLEClient()
-        asyncio.create_task(self.ble_client.connect())
-        asyncio.create_task(self._update_pedestal_state_loop())
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
+        if hubs is None:
+            hubs = {DEFAULT_HUB_ID: None}
+        self.hubs = {
+            hub_id: Hub(hub_id, transport, write_tick, self._flush_writes)
+            for hub_id, transport in sorted(hubs.items())
+        }
+        for hub in self.hubs.values():
+            hub.ble_client.notification_handler = self._parse_notification_data(hub)
+            hub.ble_client.connected_handler = self._restore_groups_handler(hub)
+            asyncio.create_task(hub.ble_client.connect())
+            asyncio.create_task(self._update_pedestal_state_loop(hub))
         self.pedestals = []
+        # Addresses of pedestals that may be running an effect on their hub
+        self.effect_addresses = set()
+        self.state_store = state_store
+        # Publishes pedestal state to websocket clients whenever it changes
+        self.broadcaster = Broadcaster("getPedestals", "pedestalsDelta")
+        WEBSOCKET_CLIENTS.set_function(lambda: len(self.broadcaster.subscriptions))
+        BROADCAST_QUEUE_DEPTH.set_function(
+            lambda: sum(s.queue.qsize() for s in self.broadcaster.subscriptions)
+        )
+        # Start from the last known state, marked stale until the hubs report their state
+        if state_store is not None:
+            for pedestal in state_store.load():
+                hub = self.hubs.get(pedestal["address"].split(":")[0])
+                if hub is not None and ":" in pedestal["address"]:
+                    hub.pedestals.append(pedestal)
+        self._merge_pedestals()
 
     async def get_pedestals(self, refresh_cache=False):
-        """Gets pedestals, with or without refreshing the cache by reaching out to the hub."""
-        if self.mock:
-            return self.mock_pedestals
+        """Gets pedestals, with or without refreshing the cache by reaching out to the hubs."""
         if refresh_cache:
-            await asyncio.create_task(
-                self.ble_client.send_command_request(
-                    Command.GET_PEDESTALS,
-                    response_handler=self._parse_pedestal_response_data(
-                        "get_pedestals"
-                    ),
-                )
+            await asyncio.gather(
+                *[self._refresh_hub(hub) for hub in self.hubs.values()]
             )
         return self.pedestals
 
-    async def _update_pedestal_state_loop(self):
+    async def _refresh_hub(self, hub, priority=Priority.INTERACTIVE):
+        state_hash = hub.state_hash if hub.reported and hub.state_hash else []
+        await hub.ble_client.send_command_request(
+            Command.GET_PEDESTALS,
+            *state_hash,
+            response_handler=self._parse_pedestal_response_data(hub, "get_pedestals"),
+            priority=priority,
+        )
+
+    async def _update_pedestal_state_loop(self, hub):
+        interval = POLL_INTERVAL_MIN
         while True:
-            await self.get_pedestals(refresh_cache=True)
-            await asyncio.sleep(1)
+            hub.wake.clear()
+            previous = hub.pedestals
+            # Polls give way to user commands, see CommandMultiplexer
+            await self._refresh_hub(hub, priority=Priority.BACKGROUND)
+            fast = time.monotonic() < hub.fast_poll_until
+            if fast or hub.pedestals != previous:
+                interval = POLL_INTERVAL_MIN
+            else:
+                interval = min(
+                    interval * 2,
+                    PUSH_POLL_INTERVAL_MAX if hub.pushes else POLL_INTERVAL_MAX,
+                )
+            if not self.broadcaster.subscriptions and not fast:
+                # Nobody is watching, wait for a subscriber or a write
+                await hub.wake.wait()
+                continue
+            try:
+                await asyncio.wait_for(hub.wake.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
 
-    async def set_pedestals_color(self, pedestals_color):
-        data = [
-            pedestal_color["address"] + pedestal_color["color"]
+    def _poll_fast(self, hub):
+        """Polls the hub right away, then at the minimum interval for the fast poll period."""
+        hub.fast_poll_until = time.monotonic() + FAST_POLL_PERIOD
+        hub.wake.set()
+
+    def subscribe(self, delta=False):
+        """Subscribes to pedestal state updates, refreshing the state. See Broadcaster.subscribe."""
+        subscription = self.broadcaster.subscribe(delta=delta)
+        for hub in self.hubs.values():
+            hub.wake.set()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.broadcaster.unsubscribe(subscription)
+
+    async def set_pedestals_color(self, pedestals_color, force=False):
+        """
+        Sets pedestal colors, skipping pedestals already that color unless forced.
+
+        Returns right away, without a command to the hubs, if no pedestal would change.
+        """
+        colors = {
+            pedestal_color["address"]: pedestal_color["color"].lower()
             for pedestal_color in pedestals_color
-        ]
-        if self.mock:
-            for new_pedestal in pedestals_color:
-                for pedestal in self.mock_pedestals:
-                    if pedestal["address"] == new_pedestal["address"]:
-                        pedestal["color"] = new_pedestal["color"]
-            return self.mock_pedestals
-        await asyncio.create_task(
-            self.ble_client.send_command_request(
-                Command.SET_PEDESTALS_COLOR,
-                *data,
-                response_handler=self._parse_pedestal_response_data(
-                    "set_pedestals_color"
-                ),
+        }
+        if not force:
+            colors = self._changed(colors, "color", self.effect_addresses)
+        if colors:
+            self.effect_addresses.difference_update(colors)
+            await asyncio.gather(
+                *[
+                    hub.write_scheduler.write(colors=hub_colors)
+                    for hub, hub_colors in self._by_hub(colors).items()
+                ]
             )
-        )
         return self.pedestals
 
-    async def blink_pedestals(self, addresses):
-        if self.mock:
-            for new_address in addresses:
-                for pedestal in self.mock_pedestals:
-                    if pedestal["address"] == new_address:
-                        pedestal["blinking"] = True
-            return self.mock_pedestals
-        await asyncio.create_task(
-            self.ble_client.send_command_request(
-                Command.BLINK_PEDESTALS,
-                *addresses,
-                response_handler=self._parse_pedestal_response_data("blink_pedestals"),
+    async def blink_pedestals(self, addresses, force=False):
+        """Starts pedestals blinking, skipping pedestals already blinking unless forced."""
+        return await self._set_pedestals_blinking(addresses, True, force)
+
+    async def stop_pedestals_blinking(self, addresses, force=False):
+        """Stops pedestals blinking, skipping pedestals already solid unless forced."""
+        return await self._set_pedestals_blinking(addresses, False, force)
+
+    async def _set_pedestals_blinking(self, addresses, blink, force):
+        blinking = {address: blink for address in addresses}
+        if not force:
+            blinking = self._changed(blinking, "blinking")
+        if blinking:
+            await asyncio.gather(
+                *[
+                    hub.write_scheduler.write(blinking=hub_blinking)
+                    for hub, hub_blinking in self._by_hub(blinking).items()
+                ]
             )
-        )
         return self.pedestals
 
-    async def stop_pedestals_blinking(self, addresses):
-        if self.mock:
-            for new_address in addresses:
-                for pedestal in self.mock_pedestals:
-                    if pedestal["address"] == new_address:
-                        pedestal["blinking"] = False
-            return self.mock_pedestals
-        await asyncio.create_task(
-            self.ble_client.send_command_request(
-                Command.STOP_PEDESTALS_BLINKING,
-                *addresses,
-                response_handler=self._parse_pedestal_response_data(
-                    "stop_pedestals_blinking"
-                ),
+    def _by_hub(self, values):
+        """Splits values keyed by global address by hub, dropping addresses of unknown hubs."""
+        by_hub = {}
+        for address, value in values.items():
+            hub = self.hubs.get(address.split(":")[0])
+            if hub is None or ":" not in address:
+                self.logger.error(f"no hub for pedestal address {address}")
+                continue
+            by_hub.setdefault(hub, {})[address] = value
+        return by_hub
+
+    def _changed(self, values, key, always=()):
+        """
+        Returns the values, by address, that differ from the pedestals' known state.
+
+        Values pending in a hub's write scheduler, then values being flushed, are compared
+        against rather than the reported state, which doesn't reflect them yet. Nothing is skipped
+        for hubs that haven't reported their state since startup, and addresses in `always` are
+        never skipped.
+        """
+        changed = {}
+        for hub, hub_values in self._by_hub(values).items():
+            scheduler = hub.write_scheduler
+            if key == "color":
+                pending, in_flight = scheduler.colors, scheduler.in_flight_colors
+            else:
+                pending, in_flight = scheduler.blinking, scheduler.in_flight_blinking
+            known = {pedestal["address"]: pedestal[key] for pedestal in hub.pedestals}
+            for address, value in hub_values.items():
+                expected = pending.get(address, in_flight.get(address, known.get(address)))
+                if not hub.reported or address in always or expected != value:
+                    changed[address] = value
+        return changed
+
+    async def set_pedestals_effect(self, effect):
+        """
+        Runs an effect on the hubs, which animate the pedestals without further commands.
+
+        Args:
+            effect (Dict): The effect, with keys:
+                - addresses: The pedestal addresses to run the effect on
+                - keyframes: A list of {"position", "color"} keyframes, with positions from 0 to
+                  1 across the duration. No keyframes stops any effect on the pedestals.
+                - duration: Milliseconds for one pass through the keyframes
+                - easing: One of "linear", "easeIn", "easeOut", or "easeInOut"
+                - loop: Whether the effect repeats until stopped
+        """
+        addresses = effect.get("addresses", [])
+        by_hub = self._by_hub({address: None for address in addresses})
+        # The effect replaces colors not yet sent for its pedestals
+        for hub, hub_addresses in by_hub.items():
+            for address in hub_addresses:
+                hub.write_scheduler.colors.pop(address, None)
+        # Pedestals running an effect change color on their own, so colors set on them are
+        # never skipped as unchanged
+        if effect.get("keyframes"):
+            self.effect_addresses.update(addresses)
+        else:
+            self.effect_addresses.difference_update(addresses)
+        keyframes = [
+            (
+                round(min(max(float(keyframe["position"]), 0), 1) * 255),
+                int(keyframe["color"][0:2], 16),
+                int(keyframe["color"][2:4], 16),
+                int(keyframe["color"][4:6], 16),
             )
+            for keyframe in effect.get("keyframes", [])
+        ]
+        duration = min(max(int(effect.get("duration", 1000)), 0), MAX_EFFECT_DURATION)
+        easing = EASINGS.get(effect.get("easing"), Easing.LINEAR)
+        loop = 1 if effect.get("loop") else 0
+        for hub in by_hub:
+            self._poll_fast(hub)
+        await asyncio.gather(
+            *[
+                hub.ble_client.send_command_request(
+                    Command.SET_PEDESTALS_EFFECT,
+                    duration,
+                    easing,
+                    loop,
+                    [i2c_address(address) for address in hub_addresses],
+                    keyframes,
+                    response_handler=self._parse_pedestal_response_data(
+                        hub, "set_pedestals_effect"
+                    ),
+                )
+                for hub, hub_addresses in by_hub.items()
+            ]
         )
         return self.pedestals
 
-    def _parse_pedestal_response_data(self, method):
-        def _parse_data(command, data):
-            pedestals = []
-            for pedestal in data:
-                address = pedestal[0:2]
-                hex_color = pedestal[2:-1]
-                blinking = True if pedestal[-1] == "1" else False
-                pedestals.append(
-                    {"address": address, "color": hex_color, "blinking": blinking}
+    def get_groups(self):
+        """Returns the member addresses of each named group."""
+        groups = {}
+        for hub in self.hubs.values():
+            for name, (_, addresses) in hub.groups.items():
+                groups.setdefault(name, []).extend(addresses)
+        return groups
+
+    async def define_group(self, name, addresses):
+        """
+        Defines a named group of pedestals, replacing any group with the same name. A group
+        without addresses is removed.
+
+        Groups are stored on the hubs, so changing a group takes one small command per hub with
+        members, which the hub applies to every member at once.
+        """
+        by_hub = self._by_hub({address: None for address in addresses})
+        requests = []
+        for hub in self.hubs.values():
+            members = list(by_hub.get(hub, {}))
+            if name in hub.groups:
+                group = hub.groups[name][0]
+            elif members:
+                used = [group for group, _ in hub.groups.values()]
+                free = [group for group in range(MAX_GROUPS) if group not in used]
+                if not free:
+                    self.logger.error(f"no free group on hub {hub.id} for {name}")
+                    continue
+                group = free[0]
+            else:
+                continue
+            if members:
+                hub.groups[name] = (group, members)
+            else:
+                del hub.groups[name]
+            requests.append(self._send_group(hub, group, members))
+        await asyncio.gather(*requests)
+        return self.pedestals
+
+    async def _send_group(self, hub, group, addresses):
+        await hub.ble_client.send_command_request(
+            Command.DEFINE_GROUP,
+            group,
+            *[i2c_address(address) for address in addresses],
+            response_handler=self._parse_pedestal_response_data(hub, "define_group"),
+        )
+
+    def _restore_groups_handler(self, hub):
+        async def _restore_groups():
+            # The hub forgets its groups if it restarts
+            await asyncio.gather(
+                *[
+                    self._send_group(hub, group, addresses)
+                    for group, addresses in hub.groups.values()
+                ]
+            )
+
+        return _restore_groups
+
+    async def set_group_color(self, name, color, force=False):
+        """
+        Sets the color of every pedestal in the group at once, skipping hubs whose members are
+        already that color unless forced.
+        """
+        color = color.lower()
+        requests = []
+        for hub, (group, addresses) in self._group_hubs(name).items():
+            colors = {address: color for address in addresses}
+            if not force and not self._changed(colors, "color", self.effect_addresses):
+                continue
+            # The group color replaces colors not yet sent and effects on its members
+            for address in addresses:
+                hub.write_scheduler.colors.pop(address, None)
+            self.effect_addresses.difference_update(addresses)
+            self._poll_fast(hub)
+            requests.append(
+                hub.ble_client.send_command_request(
+                    Command.SET_GROUP_COLOR,
+                    group,
+                    int(color[0:2], 16),
+                    int(color[2:4], 16),
+                    int(color[4:6], 16),
+                    response_handler=self._parse_pedestal_response_data(
+                        hub, "set_group_color"
+                    ),
                 )
-            self.pedestals = pedestals
+            )
+        await asyncio.gather(*requests)
+        return self.pedestals
+
+    async def set_group_blinking(self, name, blink, force=False):
+        """
+        Starts or stops every pedestal in the group blinking at once, skipping hubs whose
+        members are already in that state unless forced.
+        """
+        requests = []
+        for hub, (group, addresses) in self._group_hubs(name).items():
+            blinking = {address: blink for address in addresses}
+            if not force and not self._changed(blinking, "blinking"):
+                continue
+            for address in addresses:
+                hub.write_scheduler.blinking.pop(address, None)
+            self._poll_fast(hub)
+            requests.append(
+                hub.ble_client.send_command_request(
+                    Command.SET_GROUP_BLINKING,
+                    group,
+                    1 if blink else 0,
+                    response_handler=self._parse_pedestal_response_data(
+                        hub, "set_group_blinking"
+                    ),
+                )
+            )
+        await asyncio.gather(*requests)
+        return self.pedestals
+
+    def _group_hubs(self, name):
+        """Returns the group ID and member addresses of the named group, by hub."""
+        group_hubs = {
+            hub: hub.groups[name] for hub in self.hubs.values() if name in hub.groups
+        }
+        if not group_hubs:
+            self.logger.error(f"no group named {name}")
+        return group_hubs
+
+    async def _flush_writes(self, hub, colors, blinking):
+        """Sends a hub's coalesced writes, at most one command per kind of write."""
+        self._poll_fast(hub)
+        requests = []
+        if colors:
+            data = [
+                (
+                    i2c_address(address),
+                    int(color[0:2], 16),
+                    int(color[2:4], 16),
+                    int(color[4:6], 16),
+                )
+                for address, color in colors.items()
+            ]
+            requests.append(
+                hub.ble_client.send_command_request(
+                    Command.SET_PEDESTALS_COLOR,
+                    *data,
+                    response_handler=self._parse_pedestal_response_data(
+                        hub, "set_pedestals_color"
+                    ),
+                )
+            )
+        blink_addresses = [
+            i2c_address(address) for address, blink in blinking.items() if blink
+        ]
+        if blink_addresses:
+            requests.append(
+                hub.ble_client.send_command_request(
+                    Command.BLINK_PEDESTALS,
+                    *blink_addresses,
+                    response_handler=self._parse_pedestal_response_data(
+                        hub, "blink_pedestals"
+                    ),
+                )
+            )
+        stop_addresses = [
+            i2c_address(address) for address, blink in blinking.items() if not blink
+        ]
+        if stop_addresses:
+            requests.append(
+                hub.ble_client.send_command_request(
+                    Command.STOP_PEDESTALS_BLINKING,
+                    *stop_addresses,
+                    response_handler=self._parse_pedestal_response_data(
+                        hub, "stop_pedestals_blinking"
+                    ),
+                )
+            )
+        await asyncio.gather(*requests)
+
+    def _parse_pedestal_response_data(self, hub, method):
+        def _parse_data(command, data):
+            if command == Command.PEDESTALS_NOT_MODIFIED:
+                # The hub's state matches the cache
+                return
+            hub.state_hash = hash_pedestal_states(data)
+            self._update_pedestals(hub, parse_pedestal_states(data, hub.id))
 
         return _parse_data
+
+    def _parse_notification_data(self, hub):
+        def _parse_data(command, data):
+            hub.pushes = True
+            hub.state_hash = hash_pedestal_states(data)
+            self._update_pedestals(hub, parse_pedestal_states(data, hub.id))
+
+        return _parse_data
+
+    def _update_pedestals(self, hub, pedestals):
+        """
+        Updates the cached pedestals with state reported by a hub, broadcasting and saving them
+        if they changed.
+        """
+        addresses = [pedestal["address"] for pedestal in pedestals]
+        if hub.reported and addresses != [p["address"] for p in hub.pedestals]:
+            # Pedestals were attached or detached, watch for more changes as they settle
+            self._poll_fast(hub)
+        hub.pedestals = pedestals
+        hub.reported = True
+        if self._merge_pedestals() and self.state_store is not None:
+            self.state_store.save(self.pedestals)
+
+    def _merge_pedestals(self):
+        """Merges every hub's pedestals into one snapshot, returning True if it changed."""
+        self.pedestals = [
+            pedestal for hub in self.hubs.values() for pedestal in hub.pedestals
+        ]
+        # Pedestals of hubs that haven't reported yet are the last known state
+        stale = any(not hub.reported and hub.pedestals for hub in self.hubs.values())
+        return self.broadcaster.publish(self.pedestals, stale=stale)
+
+
+def i2c_address(address):
+    """Returns the I2C address of a pedestal from its global address."""
+    return int(address.split(":")[1], 16)
+
+
+def parse_pedestal_states(data, hub_id):
+    """Converts pedestal state tuples from a hub into the pedestal dicts sent to clients."""
+    pedestals = []
+    for address, red, green, blue, blinking in data:
+        address = f"{hub_id}:{address:02x}"
+        hex_color = f"{red:02x}{green:02x}{blue:02x}"
+        blinking = bool(blinking)
+        pedestals.append({"address": address, "color": hex_color, "blinking": blinking})
+    return pedestals
@@ -0,0 +1,320 @@
+"""
+Simulates the hub and its pedestals in-process, so the real central and hub code can run
+without hardware.
+
+The hub runs the real CircuitPython peripheral and I2C controller code in its own thread and
+event loop, connected to the central by a simulated UART link and to a virtual I2C bus of
+pedestals that mirror the pedestal firmware.
+"""
+import asyncio
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "../../circuit_python")
+)
+
+from i2c_controller import I2CController, PedestalCommand, GENERAL_CALL_ADDRESS
+from peripheral import BLEClient as PeripheralClient
+
+
+class _Pipe:
+    """One direction of the simulated UART link, delivering bytes in order after a delay."""
+
+    def __init__(self, latency, mtu, loss, rng):
+        self.latency = latency
+        self.mtu = mtu
+        self.loss = loss
+        self.rng = rng
+        self.chunks = collections.deque()
+        self.condition = threading.Condition()
+
+    def clear(self):
+        with self.condition:
+            self.chunks.clear()
+
+    def send(self, data):
+        """Splits the data into MTU sized notifications, each of which may be lost."""
+        deliver_at = time.monotonic() + self.latency
+        with self.condition:
+            for i in range(0, len(data), self.mtu):
+                if self.loss and self.rng.random() < self.loss:
+                    continue
+                self.chunks.append((deliver_at, bytes(data[i : i + self.mtu])))
+            self.condition.notify_all()
+
+    def receive(self, timeout=0):
+        """Returns all delivered bytes, waiting up to the timeout for any to arrive."""
+        deadline = time.monotonic() + timeout
+        with self.condition:
+            while True:
+                now = time.monotonic()
+                if self.chunks and self.chunks[0][0] <= now:
+                    data = bytearray()
+                    while self.chunks and self.chunks[0][0] <= now:
+                        data += self.chunks.popleft()[1]
+                    return bytes(data)
+                wait = deadline - now
+                if wait <= 0:
+                    return b""
+                if self.chunks:
+                    wait = min(wait, self.chunks[0][0] - now)
+                self.condition.wait(wait)
+
+
+class SimulatedLink:
+    """
+    A simulated BLE UART link between the central and the hub.
+
+    Args:
+        latency (float): Seconds for each write to be delivered
+        mtu (int): Bytes per notification, writes are fragmented to this size
+        loss (float): Probability each notification is lost
+        seed (int): Seeds packet loss, for repeatable runs
+    """
+
+    def __init__(self, latency=0.01, mtu=20, loss=0.0, seed=None):
+        rng = random.Random(seed)
+        self.to_hub = _Pipe(latency, mtu, loss, rng)
+        self.to_central = _Pipe(latency, mtu, loss, rng)
+        self.advertising = threading.Event()
+        self.connected = False
+
+    def connect(self):
+        self.to_hub.clear()
+        self.to_central.clear()
+        self.advertising.clear()
+        self.connected = True
+
+    def disconnect(self):
+        self.connected = False
+
+
+class SimulatedCentralTransport:
+    """The central's end of a simulated link. See transport.BLETransport."""
+
+    def __init__(self, link):
+        self.link = link
+        self.executor = ThreadPoolExecutor(1)
+
+    @property
+    def connected(self):
+        return self.link.connected
+
+    async def connect(self):
+        # Mirrors the 5 second BLE scan timeout
+        advertising = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.link.advertising.wait, 5
+        )
+        if advertising:
+            self.link.connect()
+
+    def write(self, packet):
+        if self.link.connected:
+            self.link.to_hub.send(packet)
+
+    async def read(self):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.link.to_central.receive, 1
+        )
+
+    def disconnect(self):
+        self.link.disconnect()
+
+
+class SimulatedPeripheralTransport:
+    """The hub's end of a simulated link. See peripheral_transport.BLETransport."""
+
+    def __init__(self, link):
+        self.link = link
+
+    @property
+    def connected(self):
+        return self.link.connected
+
+    async def connect(self):
+        self.link.advertising.set()
+        while not self.link.connected:
+            await asyncio.sleep(0.01)
+
+    def write(self, packet):
+        if self.link.connected:
+            self.link.to_central.send(packet)
+
+    def read(self):
+        return self.link.to_hub.receive()
+
+    def disconnect(self):
+        self.link.disconnect()
+
+
+class VirtualPedestal:
+    """A pedestal on the virtual I2C bus, mirroring the pedestal firmware's command handling."""
+
+    def __init__(self, address, red=255, green=255, blue=255, blinking=0):
+        self.address = address
+        self.red = red
+        self.green = green
+        self.blue = blue
+        self.blinking = blinking
+        self.groups = 0
+        self.command = None
+
+    def receive(self, data):
+        self.command = data[0]
+        if self.command == PedestalCommand.SET_COLOR and len(data) == 4:
+            self.red, self.green, self.blue = data[1], data[2], data[3]
+        if self.command == PedestalCommand.SET_BLINKING and len(data) == 2:
+            self.blinking = data[1]
+        if self.command == PedestalCommand.SET_GROUPS and len(data) == 2:
+            self.groups = data[1]
+        if self.command == PedestalCommand.GROUP_SET_COLOR and len(data) == 5:
+            if data[1] & self.groups:
+                self.red, self.green, self.blue = data[2], data[3], data[4]
+        if self.command == PedestalCommand.GROUP_SET_BLINKING and len(data) == 3:
+            if data[1] & self.groups:
+                self.blinking = data[2]
+
+    def request(self, buffer):
+        if self.command in (
+            PedestalCommand.GET_STATE,
+            PedestalCommand.SET_COLOR,
+            PedestalCommand.SET_BLINKING,
+            PedestalCommand.SET_GROUPS,
+        ):
+            state = [self.red, self.green, self.blue, self.blinking]
+            for i in range(min(len(buffer), len(state))):
+                buffer[i] = state[i]
+
+
+class VirtualI2CBus:
+    """
+    A virtual I2C bus of pedestals, with the interface of busio.I2C used by I2CController.
+
+    Transactions block for the configured latency, as the real bus blocks the hub.
+
+    Args:
+        pedestals (List[VirtualPedestal]): The attached pedestals
+        latency (float): Seconds each transaction takes
+        dropout (float): Probability each transaction fails as if the pedestal was unplugged
+        seed (int): Seeds dropouts, for repeatable runs
+    """
+
+    def __init__(self, pedestals, latency=0.001, dropout=0.0, seed=None):
+        self.pedestals = {pedestal.address: pedestal for pedestal in pedestals}
+        self.detached = set()
+        self.latency = latency
+        self.dropout = dropout
+        self.rng = random.Random(seed)
+        self.locked = False
+
+    def try_lock(self):
+        if self.locked:
+            return False
+        self.locked = True
+        return True
+
+    def unlock(self):
+        self.locked = False
+
+    def scan(self):
+        time.sleep(self.latency * len(self.pedestals))
+        return sorted(
+            address for address in self.pedestals if address not in self.detached
+        )
+
+    def writeto(self, address, buffer):
+        if address == GENERAL_CALL_ADDRESS:
+            # Every attached pedestal receives general calls in the same transaction
+            time.sleep(self.latency)
+            for pedestal in self.pedestals.values():
+                if pedestal.address not in self.detached:
+                    pedestal.receive(bytes(buffer))
+            return
+        self._pedestal(address).receive(bytes(buffer))
+
+    def readfrom_into(self, address, buffer):
+        self._pedestal(address).request(buffer)
+
+    def writeto_then_readfrom(self, address, out_buffer, in_buffer):
+        # A single transaction with a repeated start, so a single latency
+        pedestal = self._pedestal(address)
+        pedestal.receive(bytes(out_buffer))
+        pedestal.request(in_buffer)
+
+    def _pedestal(self, address):
+        time.sleep(self.latency)
+        if (
+            address not in self.pedestals
+            or address in self.detached
+            or (self.dropout and self.rng.random() < self.dropout)
+        ):
+            raise OSError(19, "No such device")
+        return self.pedestals[address]
+
+    def detach(self, address):
+        self.detached.add(address)
+
+    def attach(self, address):
+        self.detached.discard(address)
+
+
+class SimulatedHub:
+    """
+    Runs the real hub code against a virtual I2C bus, in its own thread and event loop.
+
+    Args:
+        num_pedestals (int): Pedestals on the virtual bus, from address 0x30
+        latency (float): Seconds for each UART write to be delivered
+        mtu (int): Bytes per BLE notification
+        loss (float): Probability each BLE notification is lost
+        i2c_latency (float): Seconds each I2C transaction takes
+        dropout (float): Probability each I2C transaction fails
+        seed (int): Seeds loss and dropout, for repeatable runs
+    """
+
+    def __init__(
+        self,
+        num_pedestals=3,
+        latency=0.01,
+        mtu=20,
+        loss=0.0,
+        i2c_latency=0.001,
+        dropout=0.0,
+        seed=None,
+    ):
+        self.link = SimulatedLink(latency=latency, mtu=mtu, loss=loss, seed=seed)
+        self.bus = VirtualI2CBus(
+            [VirtualPedestal(0x30 + i) for i in range(num_pedestals)],
+            latency=i2c_latency,
+            dropout=dropout,
+            seed=seed,
+        )
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def central_transport(self):
+        """Returns a transport for the central's BLEClient connected to this hub."""
+        return SimulatedCentralTransport(self.link)
+
+    def _run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        client = PeripheralClient(
+            transport=SimulatedPeripheralTransport(self.link),
+            i2c_controller=I2CController(i2c=self.bus),
+        )
+        asyncio.create_task(client.connect())
+
+        while True:
+            await asyncio.sleep(10)
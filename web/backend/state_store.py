@@ -0,0 +1,140 @@
+import asyncio
+import sqlite3
+import time
+import adafruit_logging as logging
+
+from log import MyHandler
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds to batch pedestal state changes for before writing them to disk
+WRITE_INTERVAL = 5
+
+# The most change history rows to keep, older rows are deleted as new ones are written
+HISTORY_LIMIT = 100000
+
+
+class StateStore:
+    """
+    Persists the last known pedestal state, and the history of changes to each pedestal, in SQLite.
+
+    Saves are throttled, only the latest state and the changes since the last write are written
+    once per write interval, from a worker thread so the SD card doesn't block the event loop.
+    """
+
+    def __init__(self, path, write_interval=WRITE_INTERVAL):
+        """
+        Args:
+            path (str): The SQLite database file
+            write_interval (float): Seconds to batch changes for before writing them
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)  # type: ignore
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
+        self.write_interval = write_interval
+        self.executor = ThreadPoolExecutor(1)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pedestals (
+                address TEXT PRIMARY KEY,
+                color TEXT NOT NULL,
+                blinking INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY,
+                time REAL NOT NULL,
+                address TEXT NOT NULL,
+                color TEXT,
+                blinking INTEGER,
+                attached INTEGER NOT NULL
+            );
+            """
+        )
+        self.pedestals = None
+        self.history = []
+        self.flush_task = None
+
+    def load(self):
+        """Returns the last saved pedestals, ordered by address."""
+        rows = self.connection.execute(
+            "SELECT address, color, blinking FROM pedestals"
+        ).fetchall()
+        pedestals = [
+            {"address": address, "color": color, "blinking": bool(blinking)}
+            for address, color, blinking in rows
+        ]
+        pedestals.sort(key=lambda pedestal: pedestal["address"])
+        self.pedestals = pedestals
+        return pedestals
+
+    def save(self, pedestals):
+        """Records the pedestals' changes since the last save, to be written on the next flush."""
+        old_by_address = {
+            pedestal["address"]: pedestal for pedestal in self.pedestals or []
+        }
+        now = time.time()
+        addresses = set()
+        for pedestal in pedestals:
+            addresses.add(pedestal["address"])
+            if old_by_address.get(pedestal["address"]) != pedestal:
+                self.history.append(
+                    (
+                        now,
+                        pedestal["address"],
+                        pedestal["color"],
+                        int(pedestal["blinking"]),
+                        1,
+                    )
+                )
+        for address in old_by_address:
+            if address not in addresses:
+                self.history.append((now, address, None, None, 0))
+        self.pedestals = pedestals
+        if self.history and (self.flush_task is None or self.flush_task.done()):
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.write_interval)
+        # Take the pending changes on the event loop, so saves made during the write aren't lost
+        pedestals, history = self.pedestals, self.history
+        self.history = []
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                self.executor, self._write, pedestals, history
+            )
+        except sqlite3.Error as e:
+            self.logger.error(f"failed to save pedestal state: {e}")
+
+    def _write(self, pedestals, history):
+        """Writes the latest pedestals and their change history."""
+        with self.connection:
+            self.connection.execute("DELETE FROM pedestals")
+            self.connection.executemany(
+                "INSERT INTO pedestals (address, color, blinking) VALUES (?, ?, ?)",
+                [
+                    (pedestal["address"], pedestal["color"], int(pedestal["blinking"]))
+                    for pedestal in pedestals
+                ],
+            )
+            self.connection.executemany(
+                "INSERT INTO history (time, address, color, blinking, attached) "
+                "VALUES (?, ?, ?, ?, ?)",
+                history,
+            )
+            self.connection.execute(
+                "DELETE FROM history WHERE id <= (SELECT MAX(id) FROM history) - ?",
+                (HISTORY_LIMIT,),
+            )
+
+    def close(self):
+        """Writes anything pending and closes the database."""
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+        self.executor.shutdown(wait=True)
+        if self.history:
+            self._write(self.pedestals, self.history)
+            self.history = []
+        self.connection.close()
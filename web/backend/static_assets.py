@@ -0,0 +1,151 @@
+import asyncio
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+from email.utils import formatdate
+
+import adafruit_logging as logging
+from aiohttp import web
+
+from log import MyHandler
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bundles with a content hash in their file name, e.g. static/js/main.1a2b3c4d.js, never change
+HASHED_FILE_NAME = re.compile(r"\.[0-9a-f]{8,}\.")
+
+# Cache headers for hashed bundles, and for everything else which must be revalidated
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Content types worth compressing, other than text/*
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "image/svg+xml",
+}
+
+# Files smaller than this many bytes aren't worth compressing
+MIN_COMPRESS_SIZE = 256
+
+
+class Asset:
+    """A built file held in memory, with its precompressed encodings."""
+
+    def __init__(self, body, content_type, mtime, cache_control):
+        self.content_type = content_type
+        self.etag = '"{}"'.format(hashlib.sha1(body).hexdigest()[:20])
+        self.last_modified = formatdate(mtime, usegmt=True)
+        self.cache_control = cache_control
+        # Encoded bodies by content encoding, "identity" being uncompressed
+        self.bodies = {"identity": body}
+        compressible = content_type.startswith("text/") or (
+            content_type in COMPRESSIBLE_TYPES
+        )
+        if compressible and len(body) >= MIN_COMPRESS_SIZE:
+            self.bodies["gzip"] = gzip.compress(body, compresslevel=9)
+            if brotli is not None:
+                self.bodies["br"] = brotli.compress(body)
+
+
+class StaticAssets:
+    """
+    Serves the built React app from memory.
+
+    Every file in the build folder is read and compressed once, when loaded, rather than read
+    from the SD card on each request. Responses carry an ETag and Last-Modified for revalidation,
+    and hashed bundles are marked immutable. Brotli encoding is served if the brotli package is
+    installed, otherwise gzip.
+    """
+
+    def __init__(self, root):
+        """
+        Args:
+            root (str): The build folder to serve
+        """
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)  # type: ignore
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
+        self.root = root
+        self.assets = {}
+        self.load()
+
+    def load(self):
+        """Reads and compresses the build folder, replacing the assets once all are loaded."""
+        assets = {}
+        if os.path.isdir(self.root):
+            for directory, _, file_names in os.walk(self.root):
+                for file_name in file_names:
+                    path = os.path.join(directory, file_name)
+                    relative_path = os.path.relpath(path, self.root).replace(os.sep, "/")
+                    with open(path, "rb") as f:
+                        body = f.read()
+                    content_type = (
+                        mimetypes.guess_type(file_name)[0] or "application/octet-stream"
+                    )
+                    cache_control = (
+                        IMMUTABLE_CACHE_CONTROL
+                        if HASHED_FILE_NAME.search(file_name)
+                        else REVALIDATE_CACHE_CONTROL
+                    )
+                    assets[relative_path] = Asset(
+                        body, content_type, os.path.getmtime(path), cache_control
+                    )
+        self.assets = assets
+        self.logger.info(f"loaded {len(assets)} static assets from {self.root}")
+
+    async def reload(self):
+        """Loads a new build without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.load)
+
+    async def handle(self, request):
+        path = request.match_info.get("path", "") or "index.html"
+        asset = self.assets.get(path)
+        if asset is None:
+            raise web.HTTPNotFound()
+
+        headers = {
+            "ETag": asset.etag,
+            "Last-Modified": asset.last_modified,
+            "Cache-Control": asset.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("If-None-Match")
+        if if_none_match is not None:
+            if asset.etag in [tag.strip() for tag in if_none_match.split(",")]:
+                return web.Response(status=304, headers=headers)
+        elif request.headers.get("If-Modified-Since") == asset.last_modified:
+            return web.Response(status=304, headers=headers)
+
+        encoding = _preferred_encoding(
+            request.headers.get("Accept-Encoding", ""), asset.bodies
+        )
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+        return web.Response(
+            body=asset.bodies[encoding],
+            content_type=asset.content_type,
+            headers=headers,
+        )
+
+
+def _preferred_encoding(accept_encoding, bodies):
+    """Returns the smallest available encoding the client accepts."""
+    accepted = set()
+    for value in accept_encoding.split(","):
+        parts = value.strip().split(";")
+        if len(parts) > 1 and parts[1].strip() in ("q=0", "q=0.0"):
+            continue
+        accepted.add(parts[0].strip())
+    for encoding in ("br", "gzip"):
+        if encoding in accepted and encoding in bodies:
+            return encoding
+    return "identity"
@@ -0,0 +1,143 @@
+import asyncio
+import threading
+import time
+import adafruit_logging as logging
+from adafruit_ble import BLERadio
+from adafruit_ble.advertising.standard import ProvideServicesAdvertisement
+from adafruit_ble.services.nordic import UARTService
+
+from log import MyHandler
+
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds to scan for a hub advertising the UART service
+SCAN_TIMEOUT = 5
+
+# Seconds to wait for a direct connection to the last hub, before falling back to a scan
+DIRECT_CONNECT_TIMEOUT = 1
+
+# Seconds between checks for data from the hub, the most latency a read adds to a packet
+READ_INTERVAL = 0.01
+# Seconds a read waits for data before returning b"", so the reader notices a dropped link
+READ_TIMEOUT = 1
+
+
+class BLETransport:
+    """
+    Carries bytes to and from the hub over the BLE UART service.
+
+    Transports provide:
+        - connected: Whether the link is up
+        - connect(): Waits for the link to come up, or gives up after a timeout
+        - write(packet): Sends bytes to the hub
+        - read(): Waits for bytes from the hub, returning b"" on timeout
+        - disconnect(): Takes the link down
+    """
+
+    # The radio can only run one scan at a time, shared by the transports to each hub
+    scan_lock = threading.Lock()
+
+    def __init__(self, name=None):
+        """
+        Args:
+            name (str): The BLE name of the hub to connect to, or None to connect to any hub
+        """
+        self.name = name
+        self.executor = ThreadPoolExecutor(1)
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.logger.setLevel(logging.INFO)  # type: ignore
+        # The logger is shared by every instance, e.g. one per hub, so log each line once
+        if not self.logger.hasHandlers():
+            self.logger.addHandler(MyHandler(self.__class__.__name__))
+        self.ble = BLERadio()
+        self.connection = None
+        self.uart = None
+        # The last hub's address and connection interval, to reconnect without scanning
+        self.address = None
+        self.connection_interval = None
+
+    @property
+    def connected(self):
+        # Other transports may be connected to other hubs on the same radio
+        return self.connection is not None and self.connection.connected
+
+    async def connect(self):
+        # Allow the coroutine to yield by connecting in a new thread
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._connect)
+
+    def _connect(self):
+        """Connects directly to the last hub if there was one, falling back to a full scan."""
+        if self.address is not None:
+            try:
+                self.logger.info("connecting directly to the last hub")
+                self._on_connected(
+                    self.ble.connect(self.address, timeout=DIRECT_CONNECT_TIMEOUT)
+                )
+                return
+            except Exception as e:
+                self.logger.info(f"direct connect failed, scanning: {e}")
+
+        with self.scan_lock:
+            self.logger.info("starting scanning")
+            try:
+                for advertisement in self.ble.start_scan(
+                    ProvideServicesAdvertisement, timeout=SCAN_TIMEOUT
+                ):
+                    if (
+                        advertisement is not None
+                        and UARTService not in advertisement.services  # type: ignore
+                    ):
+                        continue
+                    if self.name is not None and advertisement.complete_name != self.name:
+                        continue
+                    self.logger.info("found UART service, connecting")
+                    self.address = advertisement.address
+                    self._on_connected(self.ble.connect(advertisement))
+                    break
+            except Exception as e:
+                self.logger.error(f"BLE scanning failed: {e}")
+            finally:
+                self.ble.stop_scan()
+
+    def _on_connected(self, connection):
+        self.connection = connection
+        self.uart = connection[UARTService]
+        # Not every _bleio implementation supports the connection interval, e.g. Blinka's
+        try:
+            if self.connection_interval is not None:
+                connection.connection_interval = self.connection_interval
+            else:
+                self.connection_interval = connection.connection_interval
+        except Exception as e:
+            self.logger.warning(f"connection interval unavailable: {e}")
+        self.logger.info("connected")
+
+    def write(self, packet):
+        if self.connected and self.uart is not None:
+            self.uart.write(packet)
+
+    async def read(self):
+        """
+        Waits for data from the hub, returning all buffered bytes, or b"" on timeout.
+
+        The UART's RX characteristic buffer is filled by BLE notifications on another thread.
+        Blocking reads of it only check for data every 100 ms on Blinka, so the buffer is polled
+        from the event loop instead, only reading bytes that have already arrived.
+        """
+        deadline = time.monotonic() + READ_TIMEOUT
+        while self.connected and self.uart is not None:
+            try:
+                in_waiting = self.uart.in_waiting
+                if in_waiting > 0:
+                    return self.uart.read(in_waiting) or b""
+            except Exception as e:
+                self.logger.error(f"UART read failed: {e}")
+                return b""
+            if time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(READ_INTERVAL)
+        return b""
+
+    def disconnect(self):
+        if self.connected:
+            self.connection.disconnect()
@@ -0,0 +1,57 @@
+import asyncio
+
+
+class WriteScheduler:
+    """
+    Coalesces pedestal color and blinking writes.
+
+    Pending writes are merged per address, with the last writer winning, and flushed once per
+    tick. Writes made while a flush is in flight are merged into the next flush rather than
+    queuing behind it. Every caller waiting on a flush is resolved when it completes.
+    """
+
+    def __init__(self, flush, tick=0.05):
+        """
+        Args:
+            flush (Callable[[Dict[str, str], Dict[str, bool]], Awaitable]): Writes the pending
+                colors and blinking states, keyed by pedestal address
+            tick (float): Seconds to wait for more writes before flushing
+        """
+        self.flush = flush
+        self.tick = tick
+        self.colors = {}
+        self.blinking = {}
+        # The writes being flushed, until the flush returns
+        self.in_flight_colors = {}
+        self.in_flight_blinking = {}
+        self.waiters = []
+        self.flush_task = None
+
+    async def write(self, colors=None, blinking=None):
+        """Schedules colors and blinking states by address, waiting until they are flushed."""
+        self.colors.update(colors or {})
+        self.blinking.update(blinking or {})
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self._flush_loop())
+        await waiter
+
+    async def _flush_loop(self):
+        while self.waiters:
+            await asyncio.sleep(self.tick)
+            colors, blinking, waiters = self.colors, self.blinking, self.waiters
+            self.colors, self.blinking, self.waiters = {}, {}, []
+            self.in_flight_colors, self.in_flight_blinking = colors, blinking
+            try:
+                await self.flush(colors, blinking)
+            except Exception as e:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                for waiter in waiters:
+                    if not waiter.done():
+                        waiter.set_result(None)
+            finally:
+                self.in_flight_colors, self.in_flight_blinking = {}, {}
@@ -9,7 +9,7 @@ import { useEffect, useState } from "react";
 const PedestalBrowser = () => {
   // Connected websocket connections will receive async pedestal state updates at
   // a regular interval
-  const { lastReceived: getPedestalData } = useWebSocketAPI(
+  const { lastReceived: getPedestalData, stale } = useWebSocketAPI(
     WebSocketAPIMethod.GET_PEDESTALS
   );
 
@@ -113,6 +113,7 @@ const PedestalBrowser = () => {
           <div>
             <div className="text-center pt-4">
               {items?.length || 0} pedestals discovered
+              {stale && " (last known state, connecting to hub)"}
             </div>
           </div>
           <div className="flex flex-col gap-4">
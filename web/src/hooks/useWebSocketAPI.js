@@ -1,21 +1,21 @@
-import { useCallback, useEffect, useState } from "react";
+import { useCallback, useEffect, useRef, useState } from "react";
 import useWebSocket from "react-use-websocket";
-import usePrevious from "./usePrevious";
 
 export const useWebSocketAPI = (method) => {
+  // Delta mode sends a versioned snapshot of the pedestals on connect, followed by
+  // only the per-address changes
   const {
     sendJsonMessage,
     lastJsonMessage: latestJsonMessage,
     readyState,
   } = useWebSocket(
-    `ws://${window.location.hostname}:${window.location.port}/websocket`,
+    `ws://${window.location.hostname}:${window.location.port}/websocket?mode=delta`,
     {
       shouldReconnect: (closeEvent) => true,
       reconnectAttempts: Infinity,
       share: true,
     }
   );
-  const previousJsonMessage = usePrevious(latestJsonMessage);
 
   const send = useCallback(
     (data = {}) => {
@@ -31,25 +31,90 @@ export const useWebSocketAPI = (method) => {
 
   const [lastReceived, setLastReceived] = useState(null);
 
+  // Whether the last pedestal state received is the backend's last known state, not yet
+  // confirmed by the hub
+  const [stale, setStale] = useState(false);
+
+  // The version of the last pedestal state received, used to detect missed deltas
+  const version = useRef(null);
+
   useEffect(() => {
+    if (!method || !latestJsonMessage?.data) return;
+
     if (
-      method &&
-      method === latestJsonMessage?.method &&
-      !!latestJsonMessage?.data &&
-      JSON.stringify(latestJsonMessage) !== JSON.stringify(previousJsonMessage)
+      method === WebSocketAPIMethod.GET_PEDESTALS &&
+      latestJsonMessage.method === PEDESTALS_DELTA
     ) {
+      if (
+        version.current === null ||
+        latestJsonMessage.version !== version.current + 1
+      ) {
+        // An update was missed, so the delta can't be applied
+        version.current = null;
+        sendJsonMessage({ method: RESYNC });
+        return;
+      }
+      version.current = latestJsonMessage.version;
+      setStale(!!latestJsonMessage.stale);
+      setLastReceived((pedestals) =>
+        applyPedestalsDelta(pedestals || [], latestJsonMessage.data)
+      );
+      return;
+    }
+
+    // The backend only sends pedestal state when it changes, so every matching
+    // message is new data
+    if (method === latestJsonMessage.method) {
+      if (latestJsonMessage.version !== undefined) {
+        version.current = latestJsonMessage.version;
+      }
+      setStale(!!latestJsonMessage.stale);
       setLastReceived(latestJsonMessage.data);
     }
     // eslint-disable-next-line react-hooks/exhaustive-deps
   }, [method, latestJsonMessage]);
 
-  return { send, lastReceived, readyState };
+  return { send, lastReceived, stale, readyState };
 };
 
+// Orders pedestals by hub ID, then by I2C address, as the backend does. Addresses are
+// "<hub ID>:<I2C address in hex>"
+const compareAddresses = (a, b) => {
+  const [hubA, i2cA] = a.split(":");
+  const [hubB, i2cB] = b.split(":");
+  if (hubA !== hubB) {
+    return hubA < hubB ? -1 : 1;
+  }
+  return parseInt(i2cA, 16) - parseInt(i2cB, 16);
+};
+
+// Applies added, removed, and changed pedestals to a pedestal list, ordered by address
+const applyPedestalsDelta = (pedestals, { added, removed, changed }) => {
+  const changesByAddress = Object.fromEntries(
+    changed.map((change) => [change.address, change])
+  );
+  return pedestals
+    .filter((pedestal) => !removed.includes(pedestal.address))
+    .map((pedestal) => ({ ...pedestal, ...changesByAddress[pedestal.address] }))
+    .concat(added)
+    .sort((a, b) => compareAddresses(a.address, b.address));
+};
+
+// Sent by the backend with the changes since the previous pedestal state version
+const PEDESTALS_DELTA = "pedestalsDelta";
+
+// Requests a full pedestal snapshot after a missed delta
+const RESYNC = "resync";
+
 export const WebSocketAPIMethod = {
   HEALTHCHECK: "healthcheck",
   GET_PEDESTALS: "getPedestals",
   SET_PEDESTALS_COLOR: "setPedestalsColor",
   BLINK_PEDESTALS: "blinkPedestals",
   STOP_PEDESTALS_BLINKING: "stopPedestalsBlinking",
+  SET_PEDESTALS_EFFECT: "setPedestalsEffect",
+  GET_GROUPS: "getGroups",
+  DEFINE_GROUP: "defineGroup",
+  SET_GROUP_COLOR: "setGroupColor",
+  SET_GROUP_BLINKING: "setGroupBlinking",
 };